@@ -0,0 +1,174 @@
+"""
+Long-lived inference service: the models stay loaded between requests, so the latency of a
+request does not include reading the checkpoints.
+
+    python api_server.py --port 7861
+    curl -X POST localhost:7861/generate -d '{"source_image": "examples/source_image/art_0.png", "driven_audio": "examples/driven_audio/bus_chinese.wav"}'
+
+Register a source image once with POST /avatars {"avatar_id", "source_image"}, then animate it with
+POST /render {"avatar_id", "driven_audio"}.
+
+With `--render_batch_size 16`, concurrent /render requests share the generator calls of the face renderer
+(the scheduler metrics are reported by GET /health).
+
+Use `--socket /tmp/sadtalker.sock` to serve on a Unix socket instead (`curl --unix-socket ...`).
+"""
+import os, json, shutil, tempfile, threading, traceback
+import socketserver
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.gradio_demo import SadTalker
+from src.avatar import AvatarRegistry, valid_avatar_id
+
+# keyword arguments of SadTalker.test accepted in the request body, the results always go to --result_dir
+TEST_ARGS = ['preprocess', 'still_mode', 'use_enhancer', 'batch_size', 'size', 'pose_style', 'exp_scale',
+             'use_ref_video', 'ref_video', 'ref_info', 'use_idle_mode', 'length_of_audio', 'use_blink']
+# keyword arguments of AvatarRegistry.register / render
+REGISTER_ARGS = ['preprocess', 'size', 'still_mode']
+RENDER_ARGS = ['pose_style', 'exp_scale', 'batch_size', 'use_enhancer', 'use_blink', 'chunk_size']
+
+
+class SadTalkerHandler(BaseHTTPRequestHandler):
+
+    # set in main()
+    sad_talker = None
+    avatars = None
+    result_dir = './results'
+    lock = threading.Lock()
+
+    def address_string(self):
+        # client_address is an empty string on Unix sockets
+        return str(self.client_address)
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send_json(404, {'error': 'unknown path %s' % self.path})
+        # the caches are changed under the lock by the other requests, read them there
+        with self.lock:
+            models = [str(k) for k in self.sad_talker.models]
+            facerenders = [str(k) for k in self.sad_talker.facerenders]
+            avatars = list(self.avatars.avatars)
+            schedulers = [(str(k), v.scheduler) for k, v in self.sad_talker.facerenders.items() if v.scheduler is not None]
+        self._send_json(200, {'models': models, 'facerenders': facerenders, 'avatars': avatars,
+                              'render_schedulers': {k: scheduler.metrics() for k, scheduler in schedulers}})
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_POST(self):
+        if self.path == '/avatars':
+            return self.register_avatar()
+        if self.path == '/render':
+            return self.render_avatar()
+        if self.path != '/generate':
+            return self._send_json(404, {'error': 'unknown path %s' % self.path})
+
+        # SadTalker.test moves its inputs into the result folder, work on copies
+        input_dir = tempfile.mkdtemp()
+        try:
+            request = self._read_json()
+            kwargs = {k: request[k] for k in TEST_ARGS if k in request}
+
+            source_image = shutil.copy(request['source_image'], input_dir)
+            driven_audio = request.get('driven_audio')
+            if driven_audio is not None:
+                driven_audio = shutil.copy(driven_audio, input_dir)
+
+            # the models are shared, run one request at a time
+            with self.lock:
+                video_path = self.sad_talker.test(source_image, driven_audio, result_dir=self.result_dir, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            return self._send_json(500, {'error': str(e)})
+        finally:
+            shutil.rmtree(input_dir, ignore_errors=True)
+
+        self._send_json(200, {'video': os.path.abspath(video_path)})
+
+    def register_avatar(self):
+        try:
+            request = self._read_json()
+            if not valid_avatar_id(request.get('avatar_id')):
+                return self._send_json(400, {'error': 'invalid avatar_id, use letters, digits, _ and -'})
+            kwargs = {k: request[k] for k in REGISTER_ARGS if k in request}
+            self.avatars.register(request['avatar_id'], request['source_image'], **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            return self._send_json(500, {'error': str(e)})
+
+        self._send_json(200, {'avatar_id': request['avatar_id']})
+
+    def render_avatar(self):
+        try:
+            request = self._read_json()
+            if request.get('avatar_id') not in self.avatars:
+                return self._send_json(404, {'error': 'unknown avatar %s' % request.get('avatar_id')})
+            kwargs = {k: request[k] for k in RENDER_ARGS if k in request}
+            video_path = self.avatars.render(request['avatar_id'], request['driven_audio'], result_dir=self.result_dir, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            return self._send_json(500, {'error': str(e)})
+
+        self._send_json(200, {'video': os.path.abspath(video_path)})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def main(args):
+    SadTalkerHandler.sad_talker = SadTalker(args.checkpoint_dir, args.config_dir, lazy_load=True, max_cached_models=args.max_cached_models,
+                                          preprocess_cache_dir=args.preprocess_cache_dir,
+                                          render_batch_size=args.render_batch_size, render_max_wait=args.render_max_wait_ms/1000.)
+    SadTalkerHandler.result_dir = args.result_dir
+    SadTalkerHandler.avatars = AvatarRegistry(SadTalkerHandler.sad_talker, args.avatar_dir, lock=SadTalkerHandler.lock)
+    for size in args.preload_size:
+        SadTalkerHandler.sad_talker.load_models(size, args.preload_preprocess)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, SadTalkerHandler)
+        print('SadTalker server listening on', args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), SadTalkerHandler)
+        print('SadTalker server listening on http://%s:%d' % (args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--config_dir", default='./src/config', help="path to the configs")
+    parser.add_argument("--host", default='127.0.0.1', help="address of the http server")
+    parser.add_argument("--port", type=int, default=7861, help="port of the http server")
+    parser.add_argument("--socket", default=None, help="serve on this unix socket instead of http host/port")
+    parser.add_argument("--max_cached_models", type=int, default=2, help="number of model variants kept in memory")
+    parser.add_argument("--preprocess_cache_dir", default=None, help="folder where the preprocessing results of the inputs are reused across requests")
+    parser.add_argument("--result_dir", default='./results', help="where the videos of the requests are saved")
+    parser.add_argument("--avatar_dir", default='./avatars', help="where the preprocessing results of the registered avatars are stored")
+    parser.add_argument("--render_batch_size", type=int, default=0, help="batch the frames of concurrent /render requests, up to this many frames per generator call (0: off)")
+    parser.add_argument("--render_max_wait_ms", type=float, default=10, help="how long the render scheduler waits for other requests to fill a batch")
+    parser.add_argument("--preload_size", type=int, nargs='*', default=[256], help="load the models of these sizes at start")
+    parser.add_argument("--preload_preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="preprocess of the preloaded models")
+
+    args = parser.parse_args()
+
+    main(args)
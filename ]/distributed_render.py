@@ -0,0 +1,106 @@
+"""
+Render long clips on several machines sharing a folder (see src/facerender/distributed.py).
+
+    # on any node: preprocessing and audio2coeff, then the segments are queued
+    python distributed_render.py submit --source_image examples/source_image/art_0.png --driven_audio lecture.wav --job_root /shared/jobs
+    # on every render node
+    python distributed_render.py worker --job_root /shared/jobs
+    # once all the segments are rendered
+    python distributed_render.py merge --job_root /shared/jobs --job_id <id>
+"""
+import os, sys, time
+import torch
+from argparse import ArgumentParser
+
+from src.facerender.distributed import SegmentQueue, submit_job, run_worker, merge_job
+from src.utils.init_path import init_path
+
+
+def submit(args, queue):
+    from src.utils.preprocess import CropAndExtract
+    from src.test_audio2coeff import Audio2Coeff
+    from src.generate_batch import get_data
+    from src.generate_facerender_batch import get_facerender_data
+
+    sadtalker_paths = init_path(args.checkpoint_dir, args.config_dir, args.size, args.old_version, args.preprocess)
+    preprocess_model = CropAndExtract(sadtalker_paths, args.device, cache_dir=args.preprocess_cache_dir)
+    audio_to_coeff = Audio2Coeff(sadtalker_paths, args.device)
+
+    save_dir = os.path.join(args.job_root, 'inputs', time.strftime("%Y_%m_%d_%H.%M.%S"))
+    os.makedirs(save_dir, exist_ok=True)
+
+    first_coeff, crop_pic_path, crop_info = preprocess_model.generate(args.source_image, save_dir, args.preprocess,
+                                                                       source_image_flag=True, pic_size=args.size)
+    if first_coeff is None:
+        print("Can't get the coeffs of the input")
+        return
+
+    batch = get_data(first_coeff, args.driven_audio, args.device, None, still=args.still)
+    coeff = audio_to_coeff.generate(batch, save_dir, args.pose_style, None)
+
+    data = get_facerender_data(coeff, crop_pic_path, first_coeff, args.driven_audio, args.batch_size,
+                               expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+    job_id = submit_job(queue, data, args.job_root, args.source_image, crop_info, preprocess=args.preprocess, size=args.size,
+                        enhancer=args.enhancer, background_enhancer=args.background_enhancer, segment_size=args.segment_size)
+    print('Submitted job', job_id)
+
+
+def main(args):
+    os.makedirs(args.job_root, exist_ok=True)
+    queue = SegmentQueue(os.path.join(args.job_root, 'queue.db'), lease_seconds=args.lease_seconds)
+
+    if args.command == 'submit':
+        submit(args, queue)
+    elif args.command == 'worker':
+        run_worker(queue, args.checkpoint_dir, args.config_dir, args.device, chunk_size=args.chunk_size,
+                   old_version=args.old_version, exit_when_idle=args.exit_when_idle)
+    elif args.command == 'merge':
+        result = merge_job(queue, args.job_id, args.output)
+        if result is None:
+            print('Job %s is not rendered yet: %s' % (args.job_id, queue.status(args.job_id)))
+    elif args.command == 'status':
+        print(queue.job(args.job_id), queue.status(args.job_id))
+
+
+if __name__ == '__main__':
+
+    current_root_path = os.path.split(sys.argv[0])[0]
+
+    parser = ArgumentParser()
+    parser.add_argument("command", choices=['submit', 'worker', 'merge', 'status'])
+    parser.add_argument("--job_root", default='./jobs', help="folder shared by the nodes, holds the queue and the jobs")
+    parser.add_argument("--job_id", default=None, help="job to merge or to report")
+    parser.add_argument("--output", default=None, help="path of the merged video, defaults to the job folder")
+    parser.add_argument("--checkpoint_dir", default='./checkpoints', help="path to the checkpoints")
+    parser.add_argument("--config_dir", default=os.path.join(current_root_path, 'src/config'), help="path to the configs")
+    parser.add_argument("--lease_seconds", type=int, default=600, help="a segment claimed by a worker is handed to another one after this time")
+
+    # submit
+    parser.add_argument("--driven_audio", default='./examples/driven_audio/bus_chinese.wav', help="path to driven audio")
+    parser.add_argument("--source_image", default='./examples/source_image/full_body_1.png', help="path to source image")
+    parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
+    parser.add_argument("--batch_size", type=int, default=2,  help="the batch size of facerender")
+    parser.add_argument("--size", type=int, default=256,  help="the image size of the facerender")
+    parser.add_argument("--expression_scale", type=float, default=1.)
+    parser.add_argument("--segment_size", type=int, default=250, help="frames per segment rendered by a worker")
+    parser.add_argument('--enhancer',  type=str, default=None, help="Face enhancer, [gfpgan, RestoreFormer]")
+    parser.add_argument('--background_enhancer',  type=str, default=None, help="background enhancer, [realesrgan]")
+    parser.add_argument("--still", action="store_true", help="can crop back to the original videos for the full body aniamtion")
+    parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images" )
+    parser.add_argument("--preprocess_cache_dir", default=None, help="reuse the preprocessing results stored in this folder" )
+
+    # worker
+    parser.add_argument("--chunk_size", type=int, default=None,  help="number of frames the facerender generator renders per call")
+    parser.add_argument("--exit_when_idle", action="store_true", help="stop the worker once the queue is empty")
+
+    parser.add_argument("--cpu", dest="cpu", action="store_true")
+    parser.add_argument("--old_version",action="store_true", help="use the pth other than safetensor version" )
+
+    args = parser.parse_args()
+
+    if torch.cuda.is_available() and not args.cpu:
+        args.device = "cuda"
+    else:
+        args.device = "cpu"
+
+    main(args)
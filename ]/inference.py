@@ -11,6 +11,7 @@ from src.facerender.animate import AnimateFromCoeff
 from src.generate_batch import get_data
 from src.generate_facerender_batch import get_facerender_data
 from src.utils.init_path import init_path
+from src.facerender.onnx_backend import default_onnx_dir
 
 def main(args):
     #torch.backends.cudnn.enabled = False
@@ -33,19 +34,22 @@ def main(args):
     sadtalker_paths = init_path(args.checkpoint_dir, os.path.join(current_root_path, 'src/config'), args.size, args.old_version, args.preprocess)
 
     #init model
-    preprocess_model = CropAndExtract(sadtalker_paths, device)
+    preprocess_model = CropAndExtract(sadtalker_paths, device, cache_dir=args.preprocess_cache_dir)
 
     audio_to_coeff = Audio2Coeff(sadtalker_paths,  device)
     
-    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device)
+    onnx_dir = args.onnx_dir or default_onnx_dir(args.checkpoint_dir, args.size, args.preprocess)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, device, fuse=args.fuse_facerender, 
+                                          backend=args.facerender_backend, onnx_dir=onnx_dir)
 
     #crop image and extract 3dmm from image
     first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
     os.makedirs(first_frame_dir, exist_ok=True)
     print('3DMM Extraction for source image')
-    first_coeff_path, crop_pic_path, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
-                                                                             source_image_flag=True, pic_size=args.size)
-    if first_coeff_path is None:
+    # the coeffs are handed over in memory, the .mat files are only written with --verbose
+    first_coeff, crop_pic_path, crop_info =  preprocess_model.generate(pic_path, first_frame_dir, args.preprocess,\
+                                                                             source_image_flag=True, pic_size=args.size, verbose=args.verbose)
+    if first_coeff is None:
         print("Can't get the coeffs of the input")
         return
 
@@ -54,38 +58,39 @@ def main(args):
         ref_eyeblink_frame_dir = os.path.join(save_dir, ref_eyeblink_videoname)
         os.makedirs(ref_eyeblink_frame_dir, exist_ok=True)
         print('3DMM Extraction for the reference video providing eye blinking')
-        ref_eyeblink_coeff_path, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False)
+        ref_eyeblink_coeff, _, _ =  preprocess_model.generate(ref_eyeblink, ref_eyeblink_frame_dir, args.preprocess, source_image_flag=False, verbose=args.verbose)
     else:
-        ref_eyeblink_coeff_path=None
+        ref_eyeblink_coeff=None
 
     if ref_pose is not None:
         if ref_pose == ref_eyeblink: 
-            ref_pose_coeff_path = ref_eyeblink_coeff_path
+            ref_pose_coeff = ref_eyeblink_coeff
         else:
             ref_pose_videoname = os.path.splitext(os.path.split(ref_pose)[-1])[0]
             ref_pose_frame_dir = os.path.join(save_dir, ref_pose_videoname)
             os.makedirs(ref_pose_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_pose_coeff_path, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False)
+            ref_pose_coeff, _, _ =  preprocess_model.generate(ref_pose, ref_pose_frame_dir, args.preprocess, source_image_flag=False, verbose=args.verbose)
     else:
-        ref_pose_coeff_path=None
+        ref_pose_coeff=None
 
     #audio2ceoff
-    batch = get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=args.still)
-    coeff_path = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+    batch = get_data(first_coeff, audio_path, device, ref_eyeblink_coeff, still=args.still, torch_mel=args.torch_mel)
+    coeff = audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff, verbose=args.verbose)
 
     # 3dface render
     if args.face3dvis:
         from src.face3d.visualize import gen_composed_video
-        gen_composed_video(args, device, first_coeff_path, coeff_path, audio_path, os.path.join(save_dir, '3dface.mp4'))
+        gen_composed_video(args, device, first_coeff, coeff, audio_path, os.path.join(save_dir, '3dface.mp4'))
     
     #coeff2video
-    data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, 
+    data = get_facerender_data(coeff, crop_pic_path, first_coeff, audio_path, 
                                 batch_size, input_yaw_list, input_pitch_list, input_roll_list,
-                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size)
+                                expression_scale=args.expression_scale, still_mode=args.still, preprocess=args.preprocess, size=args.size,
+                                txt_path=os.path.join(save_dir, coeff.name+'.txt') if args.verbose else None)
     
     result = animate_from_coeff.generate(data, save_dir, pic_path, crop_info, \
-                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size)
+                                enhancer=args.enhancer, background_enhancer=args.background_enhancer, preprocess=args.preprocess, img_size=args.size, chunk_size=args.chunk_size, render_workers=args.render_workers)
     
     shutil.move(result, save_dir+'.mp4')
     print('The generated video is named:', save_dir+'.mp4')
@@ -106,6 +111,11 @@ if __name__ == '__main__':
     parser.add_argument("--pose_style", type=int, default=0,  help="input pose style from [0, 46)")
     parser.add_argument("--batch_size", type=int, default=2,  help="the batch size of facerender")
     parser.add_argument("--size", type=int, default=256,  help="the image size of the facerender")
+    parser.add_argument("--chunk_size", type=int, default=None,  help="number of frames the facerender generator renders per call, defaults to --batch_size")
+    parser.add_argument("--render_workers", type=int, default=1,  help="number of processes rendering segments of the video, for cpu-only machines")
+    parser.add_argument("--fuse_facerender", action="store_true", help="fold the batch norms and spectral norms of the facerender into its convs (inference only)")
+    parser.add_argument("--facerender_backend", default='torch', choices=['torch', 'onnx'], help="run the facerender with pytorch or onnx runtime (export with scripts/export_onnx.py)")
+    parser.add_argument("--onnx_dir", default=None, help="folder of the exported facerender, defaults to <checkpoint_dir>/onnx_<size>_<crop|full>")
     parser.add_argument("--expression_scale", type=float, default=1.,  help="the batch size of facerender")
     parser.add_argument('--input_yaw', nargs='+', type=int, default=None, help="the input yaw degree of the user ")
     parser.add_argument('--input_pitch', nargs='+', type=int, default=None, help="the input pitch degree of the user")
@@ -116,6 +126,8 @@ if __name__ == '__main__':
     parser.add_argument("--face3dvis", action="store_true", help="generate 3d face and 3d landmarks") 
     parser.add_argument("--still", action="store_true", help="can crop back to the original videos for the full body aniamtion") 
     parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'], help="how to preprocess the images" ) 
+    parser.add_argument("--torch_mel", action="store_true", help="compute the mel spectrogram with torch on the device instead of librosa" ) 
+    parser.add_argument("--preprocess_cache_dir", default=None, help="reuse the crop, landmarks and 3dmm coeffs of already processed images/videos stored in this folder" ) 
     parser.add_argument("--verbose",action="store_true", help="saving the intermedia output or not" ) 
     parser.add_argument("--old_version",action="store_true", help="use the pth other than safetensor version" ) 
 
@@ -97,10 +97,10 @@ class Predictor(BasePredictor):
         os.makedirs(first_frame_dir)
 
         print("3DMM Extraction for source image")
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(
+        first_coeff, crop_pic_path, crop_info = self.preprocess_model.generate(
             args.pic_path, first_frame_dir, preprocess, source_image_flag=True
         )
-        if first_coeff_path is None:
+        if first_coeff is None:
             print("Can't get the coeffs of the input")
             return
 
@@ -133,21 +133,21 @@ class Predictor(BasePredictor):
 
         # audio2ceoff
         batch = get_data(
-            first_coeff_path,
+            first_coeff,
             args.audio_path,
             device,
             ref_eyeblink_coeff_path,
             still=still,
         )
-        coeff_path = self.audio_to_coeff.generate(
+        coeff = self.audio_to_coeff.generate(
             batch, results_dir, args.pose_style, ref_pose_coeff_path
         )
         # coeff2video
         print("coeff2video")
         data = get_facerender_data(
-            coeff_path,
+            coeff,
             crop_pic_path,
-            first_coeff_path,
+            first_coeff,
             args.audio_path,
             args.batch_size,
             args.input_yaw,
@@ -0,0 +1,103 @@
+"""
+Check that the dense motion network gives the same deformation as the former implementation, which
+repeated the compressed feature per keypoint before grid_sample, and compare their time and memory.
+Also checks the broadcast kp2gaussian against the repeated grid version.
+
+    python scripts/compare_dense_motion.py --batch_size 8
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import yaml
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.facerender.modules.dense_motion import DenseMotionNetwork
+from src.facerender.modules.util import kp2gaussian, make_coordinate_grid
+
+
+def deformed_feature_repeat(dense_motion, feature, sparse_motions):
+    bs, _, d, h, w = feature.shape
+    num_kp = dense_motion.num_kp
+    feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, num_kp+1, 1, 1, 1, 1, 1)
+    feature_repeat = feature_repeat.view(bs * (num_kp+1), -1, d, h, w)
+    sparse_motions = sparse_motions.reshape((bs * (num_kp+1), d, h, w, -1))
+    sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
+    return sparse_deformed.view((bs, num_kp+1, -1, d, h, w))
+
+
+def kp2gaussian_repeat(kp, spatial_size, kp_variance):
+    mean = kp['value']
+    coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
+    number_of_leading_dimensions = len(mean.shape) - 1
+    coordinate_grid = coordinate_grid.view(*((1,) * number_of_leading_dimensions + coordinate_grid.shape))
+    coordinate_grid = coordinate_grid.repeat(*(mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)))
+    mean = mean.view(*(mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)))
+    return torch.exp(-0.5 * ((coordinate_grid - mean) ** 2).sum(-1) / kp_variance)
+
+
+def run(fn, device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    out = fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        return out, time.time() - start, torch.cuda.max_memory_allocated() / 2**20
+    return out, time.time() - start, float('nan')
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--config", default='src/config/facerender.yaml')
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--atol", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    common = config['model_params']['common_params']
+    generator_params = config['model_params']['generator_params']
+    dense_motion = DenseMotionNetwork(num_kp=common['num_kp'], feature_channel=common['feature_channel'],
+                                      estimate_occlusion_map=generator_params['estimate_occlusion_map'],
+                                      **generator_params['dense_motion_params']).to(args.device).eval()
+
+    torch.manual_seed(0)
+    bs, num_kp = args.batch_size, common['num_kp']
+    # the 3d feature volume of a 256 render
+    feature = torch.randn(bs, common['feature_channel'], generator_params['reshape_depth'], 64, 64, device=args.device)
+    kp_source = {'value': torch.rand(bs, num_kp, 3, device=args.device) * 2 - 1}
+    kp_driving = {'value': torch.rand(bs, num_kp, 3, device=args.device) * 2 - 1}
+
+    with torch.no_grad():
+        compressed = F.relu(dense_motion.norm(dense_motion.compress(feature)))
+        sparse_motion = dense_motion.create_sparse_motions(compressed, kp_driving, kp_source)
+
+        ref, time_ref, mem_ref = run(lambda: deformed_feature_repeat(dense_motion, compressed, sparse_motion), args.device)
+        new, time_new, mem_new = run(lambda: dense_motion.create_deformed_feature(compressed, sparse_motion), args.device)
+        err = (ref - new).abs().max().item()
+        print('deformed feature: max abs diff %.2e' % err)
+        print('repeat: %.3fs %.0fMB peak, stacked grids: %.3fs %.0fMB peak' % (time_ref, mem_ref, time_new, mem_new))
+        assert err < args.atol
+
+        spatial_size = compressed.shape[2:]
+        ref, time_ref, mem_ref = run(lambda: kp2gaussian_repeat(kp_driving, spatial_size, 0.01), args.device)
+        new, time_new, mem_new = run(lambda: kp2gaussian(kp_driving, spatial_size, 0.01), args.device)
+        err = (ref - new).abs().max().item()
+        print('kp2gaussian: max abs diff %.2e' % err)
+        print('repeat: %.3fs %.0fMB peak, broadcast: %.3fs %.0fMB peak' % (time_ref, mem_ref, time_new, mem_new))
+        assert err < args.atol
+
+        # the whole forward: mask, deformation and occlusion
+        out = dense_motion(feature, kp_driving, kp_source)
+        mask = out['mask'].unsqueeze(2)
+        mask = torch.where(mask < 1e-3, torch.zeros_like(mask), mask)
+        deformation = (sparse_motion.permute(0, 1, 5, 2, 3, 4) * mask).sum(dim=1).permute(0, 2, 3, 4, 1)
+        err = (deformation - out['deformation']).abs().max().item()
+        print('deformation: max abs diff %.2e' % err)
+        assert err < args.atol
+    print('ok')
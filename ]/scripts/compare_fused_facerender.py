@@ -0,0 +1,79 @@
+"""
+Check that the fused facerender (--fuse_facerender) gives the same keypoints, source features
+and frames as the loaded one, and compare their speed.
+
+    python scripts/compare_fused_facerender.py --checkpoint_dir checkpoints --size 256
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.facerender.animate import AnimateFromCoeff
+from src.utils.init_path import init_path
+
+
+def max_diff(a, b):
+    return (a - b).abs().max().item()
+
+
+def render(animate_from_coeff, source, kp_driving, repeat):
+    with torch.no_grad():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeat):
+            out = animate_from_coeff.generator.warp_decode(source['source_feature'], kp_driving=kp_driving,
+                                                           kp_source=source['kp_source'])
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return out['prediction'], (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--source_image", default='examples/source_image/art_0.png')
+    parser.add_argument("--checkpoint_dir", default='./checkpoints')
+    parser.add_argument("--config_dir", default='./src/config')
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--preprocess", default='crop')
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-3, help="tolerance on the frames (range [0, 1])")
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    sadtalker_paths = init_path(args.checkpoint_dir, args.config_dir, args.size, False, args.preprocess)
+    reference = AnimateFromCoeff(sadtalker_paths, device)
+    fused = AnimateFromCoeff(sadtalker_paths, device, fuse=True)
+
+    image = Image.open(args.source_image).convert('RGB').resize((args.size, args.size))
+    source_image = torch.FloatTensor(np.array(image) / 255.).permute(2, 0, 1).unsqueeze(0)
+    torch.manual_seed(0)
+    coeff_nc = 73 if 'full' in args.preprocess else 70
+    source_semantics = torch.randn(1, coeff_nc, 27) * 0.1
+
+    source_ref = reference.prepare_source(source_image, source_semantics)
+    source_fused = fused.prepare_source(source_image, source_semantics)
+    print('kp_canonical: max abs diff %.2e' % max_diff(source_ref['kp_canonical']['value'], source_fused['kp_canonical']['value']))
+    print('kp_source: max abs diff %.2e' % max_diff(source_ref['kp_source']['value'], source_fused['kp_source']['value']))
+    print('source_feature: max abs diff %.2e' % max_diff(source_ref['source_feature'], source_fused['source_feature']))
+
+    # a batch of driving keypoints around the source ones
+    kp_source = source_ref['kp_source']['value'].expand(args.batch_size, -1, -1)
+    kp_driving = {'value': kp_source + torch.randn_like(kp_source) * 0.02}
+    for source in (source_ref, source_fused):
+        source['kp_source'] = {'value': source['kp_source']['value'].expand(args.batch_size, -1, -1)}
+        source['source_feature'] = source['source_feature'].expand((args.batch_size,) + source['source_feature'].shape[1:])
+
+    frames_ref, time_ref = render(reference, source_ref, kp_driving, args.repeat)
+    frames_fused, time_fused = render(fused, source_fused, kp_driving, args.repeat)
+    err = max_diff(frames_ref, frames_fused)
+    print('frames: max abs diff %.2e' % err)
+    print('warp_decode of %d frames: %.3fs, fused %.3fs' % (args.batch_size, time_ref, time_fused))
+    assert err < args.atol
+    print('ok')
@@ -0,0 +1,46 @@
+"""
+Check that the torch mel spectrogram matches the librosa one, single and batched.
+
+    python scripts/compare_mel_frontend.py examples/driven_audio/bus_chinese.wav examples/driven_audio/deyu.wav
+"""
+import os, sys, time
+from glob import glob
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import src.utils.audio as audio
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("audio", nargs='*', help="audio files, defaults to examples/driven_audio/*.wav")
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--atol", type=float, default=1e-3, help="tolerance on the normalized mel values (range [-4, 4])")
+    args = parser.parse_args()
+
+    paths = args.audio or sorted(glob('examples/driven_audio/*.wav'))
+    wavs = [audio.load_wav(path, 16000) for path in paths]
+
+    start = time.time()
+    mels_np = [audio.melspectrogram(wav) for wav in wavs]
+    time_np = time.time() - start
+
+    for dtype in [torch.float64, torch.float32]:
+        mels_single = [audio.melspectrogram_torch(wav, args.device, dtype).cpu().numpy() for wav in wavs]
+        start = time.time()
+        mels_batch = [mel.cpu().numpy() for mel in audio.melspectrogram_torch(wavs, args.device, dtype)]
+        time_torch = time.time() - start
+
+        for path, mel_np, mel_single, mel_batch in zip(paths, mels_np, mels_single, mels_batch):
+            assert mel_np.shape == mel_single.shape == mel_batch.shape, (path, mel_np.shape, mel_single.shape, mel_batch.shape)
+            err_single = np.abs(mel_np - mel_single).max()
+            err_batch = np.abs(mel_np - mel_batch).max()
+            print('%s %s: max abs diff single %.2e, batch %.2e' % (dtype, os.path.basename(path), err_single, err_batch))
+            assert err_single < args.atol and err_batch < args.atol
+
+        print('%s: librosa %.3fs, torch batch (%s) %.3fs' % (dtype, time_np, args.device, time_torch))
+    print('ok')
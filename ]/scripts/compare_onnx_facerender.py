@@ -0,0 +1,77 @@
+"""
+Check that the onnx backend of the face renderer (scripts/export_onnx.py) gives the same keypoints,
+source features and frames as pytorch, and compare their speed.
+
+    python scripts/compare_onnx_facerender.py --checkpoint_dir checkpoints --size 256 --preprocess crop
+"""
+import os, sys, time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.facerender.animate import AnimateFromCoeff
+from src.facerender.modules.make_animation import driving_keypoints
+from src.facerender.onnx_backend import default_onnx_dir
+from src.utils.init_path import init_path
+
+
+def max_diff(a, b):
+    return (a - b).abs().max().item()
+
+
+def render(animate_from_coeff, source, target_semantics, batch_size, repeat):
+    with torch.no_grad():
+        kp_driving = driving_keypoints(source['kp_canonical'], target_semantics, animate_from_coeff.mapping)
+        kp_source = {'value': source['kp_source']['value'].expand(batch_size, -1, -1)}
+        source_feature = source['source_feature'].expand((batch_size,) + source['source_feature'].shape[1:])
+        start = time.time()
+        for _ in range(repeat):
+            out = animate_from_coeff.generator.warp_decode(source_feature, kp_driving=kp_driving, kp_source=kp_source)
+    return kp_driving['value'], out['prediction'], (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--source_image", default='examples/source_image/art_0.png')
+    parser.add_argument("--checkpoint_dir", default='./checkpoints')
+    parser.add_argument("--config_dir", default='./src/config')
+    parser.add_argument("--onnx_dir", default=None)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--preprocess", default='crop')
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cpu", action="store_true")
+    parser.add_argument("--atol", type=float, default=1e-3, help="tolerance on the frames (range [0, 1])")
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    onnx_dir = args.onnx_dir or default_onnx_dir(args.checkpoint_dir, args.size, args.preprocess)
+    sadtalker_paths = init_path(args.checkpoint_dir, args.config_dir, args.size, False, args.preprocess)
+    reference = AnimateFromCoeff(sadtalker_paths, device)
+    onnx = AnimateFromCoeff(sadtalker_paths, device, backend='onnx', onnx_dir=onnx_dir)
+
+    image = Image.open(args.source_image).convert('RGB').resize((args.size, args.size))
+    source_image = torch.FloatTensor(np.array(image) / 255.).permute(2, 0, 1).unsqueeze(0)
+    torch.manual_seed(0)
+    coeff_nc = 73 if 'full' in args.preprocess else 70
+    source_semantics = torch.randn(1, coeff_nc, 27) * 0.1
+    target_semantics = (source_semantics.unsqueeze(1) + torch.randn(1, args.batch_size, coeff_nc, 27) * 0.05).to(device)   # 1 bs C 27
+
+    source_ref = reference.prepare_source(source_image, source_semantics)
+    source_onnx = onnx.prepare_source(source_image, source_semantics)
+    print('kp_canonical: max abs diff %.2e' % max_diff(source_ref['kp_canonical']['value'], source_onnx['kp_canonical']['value']))
+    print('kp_source: max abs diff %.2e' % max_diff(source_ref['kp_source']['value'], source_onnx['kp_source']['value']))
+    print('source_feature: max abs diff %.2e' % max_diff(source_ref['source_feature'], source_onnx['source_feature']))
+
+    kp_ref, frames_ref, time_ref = render(reference, source_ref, target_semantics, args.batch_size, args.repeat)
+    kp_onnx, frames_onnx, time_onnx = render(onnx, source_onnx, target_semantics, args.batch_size, args.repeat)
+    print('kp_driving: max abs diff %.2e' % max_diff(kp_ref, kp_onnx))
+    err = max_diff(frames_ref, frames_onnx)
+    print('frames: max abs diff %.2e' % err)
+    print('warp_decode of %d frames on %s: torch %.3fs, onnx runtime %.3fs' % (args.batch_size, device, time_ref, time_onnx))
+    assert err < args.atol
+    print('ok')
@@ -0,0 +1,100 @@
+"""
+Export the face renderer to ONNX for the onnx backend (--facerender_backend onnx): the mapping net,
+the keypoint detector and the source encoder / warp decoder halves of the generator.
+The warp decoder samples 5D grids, which needs opset 20 (GridSample on volumes, torch >= 2.1).
+
+    python scripts/export_onnx.py --checkpoint_dir checkpoints --size 256 --preprocess crop
+    python scripts/compare_onnx_facerender.py --checkpoint_dir checkpoints --size 256 --preprocess crop
+"""
+import os, sys
+from argparse import ArgumentParser
+
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.facerender.animate import AnimateFromCoeff
+from src.facerender.onnx_backend import ONNX_MODELS, default_onnx_dir
+from src.utils.init_path import init_path
+
+
+class MappingExport(nn.Module):
+    def __init__(self, mapping):
+        super().__init__()
+        self.mapping = mapping
+
+    def forward(self, input_3dmm):
+        out = self.mapping(input_3dmm)
+        return tuple(out[k] for k in ONNX_MODELS['mapping'][1])
+
+
+class KPDetectorExport(nn.Module):
+    def __init__(self, kp_detector):
+        super().__init__()
+        self.kp_detector = kp_detector
+
+    def forward(self, source_image):
+        return self.kp_detector(source_image)['value']
+
+
+class EncodeSourceExport(nn.Module):
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, source_image):
+        return self.generator.encode_source(source_image)
+
+
+class WarpDecodeExport(nn.Module):
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, feature_3d, kp_source, kp_driving):
+        return self.generator.warp_decode(feature_3d, kp_driving={'value': kp_driving}, kp_source={'value': kp_source})['prediction']
+
+
+def export(model, inputs, name, output_dir, opset):
+    input_names, output_names = ONNX_MODELS[name]
+    # the batch size is dynamic
+    dynamic_axes = {k: {0: 'batch'} for k in input_names + output_names}
+    path = os.path.join(output_dir, name + '.onnx')
+    torch.onnx.export(model, inputs, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+    print('Exported', path)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--checkpoint_dir", default='./checkpoints')
+    parser.add_argument("--config_dir", default='./src/config')
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--preprocess", default='crop', choices=['crop', 'extcrop', 'resize', 'full', 'extfull'])
+    parser.add_argument("--output_dir", default=None, help="defaults to <checkpoint_dir>/onnx_<size>_<crop|full>")
+    parser.add_argument("--opset", type=int, default=20)
+    parser.add_argument("--no_fuse", action="store_true", help="export the models without folding the norms into the convs")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or default_onnx_dir(args.checkpoint_dir, args.size, args.preprocess)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # exported on cpu, the graphs run on any ORT provider
+    sadtalker_paths = init_path(args.checkpoint_dir, args.config_dir, args.size, False, args.preprocess)
+    animate_from_coeff = AnimateFromCoeff(sadtalker_paths, 'cpu', fuse=not args.no_fuse)
+    generator, kp_detector, mapping = animate_from_coeff.generator, animate_from_coeff.kp_extractor, animate_from_coeff.mapping
+
+    coeff_nc = 73 if 'full' in args.preprocess else 70
+    source_image = torch.rand(1, 3, args.size, args.size)
+    input_3dmm = torch.randn(2, coeff_nc, 27) * 0.1
+
+    with torch.no_grad():
+        kp = kp_detector(source_image)['value']
+        feature_3d = generator.encode_source(source_image)
+
+        export(MappingExport(mapping).eval(), (input_3dmm,), 'mapping', output_dir, args.opset)
+        export(KPDetectorExport(kp_detector).eval(), (source_image,), 'kp_detector', output_dir, args.opset)
+        export(EncodeSourceExport(generator).eval(), (source_image,), 'encode_source', output_dir, args.opset)
+        export(WarpDecodeExport(generator).eval(), (feature_3d.expand(2, -1, -1, -1, -1).contiguous(), kp.expand(2, -1, -1).contiguous(),
+                                                    kp.expand(2, -1, -1) + 0.01), 'warp_decode', output_dir, args.opset)
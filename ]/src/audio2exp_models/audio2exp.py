@@ -2,33 +2,63 @@ from tqdm import tqdm
 import torch
 from torch import nn
 
+# activation memory of the audio encoder for one 80x16 mel window in float32, 
+# the 32x80x16 maps of the first blocks (input, output and residual) dominate
+FRAME_ACTIVATION_BYTES = 3 * 32 * 80 * 16 * 4
+
 
 class Audio2Exp(nn.Module):
-    def __init__(self, netG, cfg, device, prepare_training_loss=False):
+    def __init__(self, netG, cfg, device, prepare_training_loss=False, memory_budget=256*1024*1024):
         super(Audio2Exp, self).__init__()
         self.cfg = cfg
         self.device = device
         self.netG = netG.to(device)
+        self.memory_budget = memory_budget
+
+    def chunk_frames(self, bs, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = max(1, int(self.memory_budget // (bs * FRAME_ACTIVATION_BYTES)))
+        return chunk_size
+
+    def encode(self, mel_input, chunk_size=None):
+        """
+        Audio embedding of every frame, bs T 512
+        """
+        bs, T = mel_input.shape[:2]
+        chunk_size = self.chunk_frames(bs, chunk_size)
+        audio_emb = [self.netG.encode(mel_input[:, i:i+chunk_size].reshape(-1, 1, 80, 16)).view(bs, -1, 512) 
+                        for i in range(0, T, chunk_size)]
+        return torch.cat(audio_emb, 1)
 
-    def test(self, batch):
+    def test(self, batch, chunk_size=None, audio_emb=None):
+        """
+        netG is frame independent, so the frames go through it in chunks as large as the 
+        memory budget allows (chunk_size frames per call if given).
+        audio_emb: precomputed encode(batch['indiv_mels']), only the head of netG runs then.
+        """
 
         mel_input = batch['indiv_mels']                         # bs T 1 80 16
         bs = mel_input.shape[0]
         T = mel_input.shape[1]
 
+        chunk_size = self.chunk_frames(bs, chunk_size)
+
         exp_coeff_pred = []
 
-        for i in tqdm(range(0, T, 10),'audio2exp:'): # every 10 frames
+        for i in tqdm(range(0, T, chunk_size),'audio2exp:'):
             
-            current_mel_input = mel_input[:,i:i+10]
+            current_mel_input = mel_input[:,i:i+chunk_size]
 
             #ref = batch['ref'][:, :, :64].repeat((1,current_mel_input.shape[1],1))           #bs T 64
-            ref = batch['ref'][:, :, :64][:, i:i+10]
-            ratio = batch['ratio_gt'][:, i:i+10]                               #bs T
-
-            audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
+            ref = batch['ref'][:, :, :64][:, i:i+chunk_size]
+            ratio = batch['ratio_gt'][:, i:i+chunk_size]                               #bs T
 
-            curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
+            if audio_emb is None:
+                audiox = current_mel_input.view(-1, 1, 80, 16)                  # bs*T 1 80 16
+                curr_exp_coeff_pred  = self.netG(audiox, ref, ratio)         # bs T 64 
+            else:
+                audiox = audio_emb[:, i:i+chunk_size].reshape(-1, audio_emb.shape[-1])  # bs*T 512
+                curr_exp_coeff_pred  = self.netG.head(audiox, ref, ratio)         # bs T 64 
 
             exp_coeff_pred += [curr_exp_coeff_pred]
 
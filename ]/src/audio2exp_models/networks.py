@@ -64,11 +64,18 @@ class SimpleWrapperV2(nn.Module):
         #nn.init.constant_(self.mapping1.weight, 0.)
         nn.init.constant_(self.mapping1.bias, 0.)
 
-    def forward(self, x, ref, ratio):
-        x = self.audio_encoder(x).view(x.size(0), -1)
+    def encode(self, x):
+        # bs*T 1 80 16 -> bs*T 512
+        return self.audio_encoder(x).view(x.size(0), -1)
+
+    def head(self, x, ref, ratio):
+        # x: audio embedding, bs*T 512
         ref_reshape = ref.reshape(x.size(0), -1)
         ratio = ratio.reshape(x.size(0), -1)
         
         y = self.mapping1(torch.cat([x, ref_reshape, ratio], dim=1)) 
         out = y.reshape(ref.shape[0], ref.shape[1], -1) #+ ref # resudial
         return out
+
+    def forward(self, x, ref, ratio):
+        return self.head(self.encode(x), ref, ratio)
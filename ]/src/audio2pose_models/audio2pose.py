@@ -45,7 +45,19 @@ class Audio2Pose(nn.Module):
 
         return batch
 
-    def test(self, x):
+    def encode(self, indiv_mels, chunk_size=512):
+        """
+        Audio embedding of every frame, bs T 512
+        """
+        return torch.cat([self.audio_encoder(indiv_mels[:, i:i+chunk_size]) 
+                            for i in range(0, indiv_mels.shape[1], chunk_size)], 1)
+
+    def test(self, x, chunk_windows=16, audio_emb=None):
+        """
+        All seq_len windows (and the remainder window) are stacked in the batch dimension and 
+        decoded chunk_windows at a time, with one z per window drawn in the window order.
+        audio_emb: precomputed encode(x['indiv_mels']), the audio encoder is skipped then.
+        """
 
         batch = {}
         ref = x['ref']                            #bs 1 70
@@ -55,36 +67,57 @@ class Audio2Pose(nn.Module):
         
         indiv_mels= x['indiv_mels']               # bs T 1 80 16
         indiv_mels_use = indiv_mels[:, 1:]        # we regard the ref as the first frame
+        audio_emb_use = audio_emb[:, 1:] if audio_emb is not None else None
         num_frames = x['num_frames']
         num_frames = int(num_frames) - 1
 
         #  
         div = num_frames//self.seq_len
         re = num_frames%self.seq_len
-        audio_emb_list = []
+
+        # the remainder window is the last seq_len frames, it starts before 0 when the audio is shorter than seq_len
+        starts = [i*self.seq_len for i in range(div)]
+        if re != 0:
+            starts.append(num_frames - self.seq_len)
+        z_list = [torch.randn(bs, self.latent_dim).to(ref.device) for _ in starts]
+
         pose_motion_pred_list = [torch.zeros(batch['ref'].unsqueeze(1).shape, dtype=batch['ref'].dtype, 
                                                 device=batch['ref'].device)]
 
-        for i in range(div):
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, i*self.seq_len:(i+1)*self.seq_len,:,:,:]) #bs seq_len 512
-            batch['audio_emb'] = audio_emb
-            batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'])  #list of bs seq_len 6
-        
-        if re != 0:
-            z = torch.randn(bs, self.latent_dim).to(ref.device)
-            batch['z'] = z
-            audio_emb = self.audio_encoder(indiv_mels_use[:, -1*self.seq_len:,:,:,:]) #bs seq_len  512
-            if audio_emb.shape[1] != self.seq_len:
-                pad_dim = self.seq_len-audio_emb.shape[1]
-                pad_audio_emb = audio_emb[:, :1].repeat(1, pad_dim, 1) 
-                audio_emb = torch.cat([pad_audio_emb, audio_emb], 1) 
-            batch['audio_emb'] = audio_emb
+        for c in range(0, len(starts), chunk_windows):
+            chunk_starts = starts[c:c+chunk_windows]
+            num_windows = len(chunk_starts)
+
+            # encode the frames of the chunk once, then cut the windows
+            offset = max(chunk_starts[0], 0)
+            if audio_emb_use is None:
+                chunk_emb = self.audio_encoder(indiv_mels_use[:, offset:chunk_starts[-1]+self.seq_len]) #bs L 512
+            else:
+                chunk_emb = audio_emb_use[:, offset:chunk_starts[-1]+self.seq_len]
+            audio_emb_list = []
+            for start in chunk_starts:
+                if start >= 0:
+                    audio_emb_list.append(chunk_emb[:, start-offset:start-offset+self.seq_len])
+                else:
+                    pad_audio_emb = chunk_emb[:, :1].repeat(1, -start, 1) 
+                    audio_emb_list.append(torch.cat([pad_audio_emb, chunk_emb], 1))
+
+            # window major: (num_windows*bs) ...
+            batch['z'] = torch.cat(z_list[c:c+num_windows], 0)
+            batch['audio_emb'] = torch.cat(audio_emb_list, 0)                   #num_windows*bs seq_len 512
+            batch['ref'] = x['ref'][:,0,-6:].repeat(num_windows, 1)
+            batch['class'] = x['class'].repeat(num_windows)
             batch = self.netG.test(batch)
-            pose_motion_pred_list.append(batch['pose_motion_pred'][:,-1*re:,:])   
-        
+            pose_motion_pred = batch['pose_motion_pred'].view(num_windows, bs, self.seq_len, -1)
+
+            for i in range(num_windows):
+                if c+i == div: # remainder window
+                    pose_motion_pred_list.append(pose_motion_pred[i, :, -1*re:, :])
+                else:
+                    pose_motion_pred_list.append(pose_motion_pred[i])   #list of bs seq_len 6
+
+        batch['ref'] = x['ref'][:,0,-6:]  
+        batch['class'] = x['class']  
         pose_motion_pred = torch.cat(pose_motion_pred_list, dim = 1)
         batch['pose_motion_pred'] = pose_motion_pred
 
@@ -0,0 +1,121 @@
+import os, re, uuid, shutil, threading, contextlib
+import torch
+
+from src.generate_batch import get_data
+from src.generate_facerender_batch import get_facerender_data, get_source_data
+
+# avatar ids name folders in avatar_dir
+AVATAR_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def valid_avatar_id(avatar_id):
+    return isinstance(avatar_id, str) and AVATAR_ID_PATTERN.fullmatch(avatar_id) is not None
+
+
+class Avatar():
+    """
+    A registered source image: the preprocessing results and the renderer inputs derived from it.
+    """
+    def __init__(self, avatar_id, pic_path, preprocess, size, still_mode,
+                 first_coeff, crop_pic_path, crop_info, source_data, source):
+        self.avatar_id = avatar_id
+        self.pic_path = pic_path
+        self.preprocess = preprocess
+        self.size = size
+        self.still_mode = still_mode
+        self.first_coeff = first_coeff
+        self.crop_pic_path = crop_pic_path
+        self.crop_info = crop_info
+        self.source_data = source_data  # get_source_data output (cropped source tensor and semantics)
+        self.source = source            # kp_canonical, kp_source (mapping output) and encoded source features
+
+
+class AvatarRegistry():
+    """
+    Register a source image once, then render it with any number of audio clips:
+    the crop, 3dmm extraction, keypoint detection and source encoding are not repeated per request.
+
+        registry = AvatarRegistry(SadTalker(lazy_load=True))
+        registry.register('art_0', 'examples/source_image/art_0.png')
+        registry.render('art_0', 'examples/driven_audio/bus_chinese.wav')
+    """
+    def __init__(self, sad_talker, avatar_dir='./avatars', lock=None):
+        self.sad_talker = sad_talker
+        self.avatar_dir = avatar_dir
+        self.avatars = {}
+        # share the lock of the other users of sad_talker's models
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def __contains__(self, avatar_id):
+        return avatar_id in self.avatars
+
+    def __getitem__(self, avatar_id):
+        return self.avatars[avatar_id]
+
+    def register(self, avatar_id, pic_path, preprocess='crop', size=256, still_mode=False):
+        if not valid_avatar_id(avatar_id):
+            raise ValueError('invalid avatar id %r, use letters, digits, _ and -' % (avatar_id,))
+        save_dir = os.path.join(self.avatar_dir, avatar_id)
+        input_dir = os.path.join(save_dir, 'input')
+        os.makedirs(input_dir, exist_ok=True)
+        # keep a copy, the full preprocess pastes the renders back on it
+        pic_path = shutil.copy(pic_path, input_dir)
+
+        with self.lock:
+            _, preprocess_model, _, animate_from_coeff = self.sad_talker.load_models(size, preprocess)
+            first_coeff, crop_pic_path, crop_info = preprocess_model.generate(pic_path, save_dir, preprocess, True, size)
+            if first_coeff is None:
+                raise AttributeError("No face is detected")
+
+            source_data = get_source_data(crop_pic_path, first_coeff, preprocess, size)
+            source = animate_from_coeff.prepare_source(source_data['source_image'], source_data['source_semantics'])
+
+        avatar = Avatar(avatar_id, pic_path, preprocess, size, still_mode,
+                        first_coeff, crop_pic_path, crop_info, source_data, source)
+        with self.lock:
+            self.avatars[avatar_id] = avatar
+        return avatar
+
+    def remove(self, avatar_id):
+        with self.lock:
+            self.avatars.pop(avatar_id, None)
+
+    def render(self, avatar_id, audio_path, result_dir='./results', pose_style=0, exp_scale=1.0,
+               batch_size=2, use_enhancer=False, use_blink=True, chunk_size=None):
+        avatar = self.avatars[avatar_id]
+
+        save_dir = os.path.join(result_dir, str(uuid.uuid4()))
+        os.makedirs(save_dir, exist_ok=True)
+
+        # the models are shared, run one request at a time. With the render scheduler only the 
+        # audio2coeff runs under the lock, the frames of the concurrent renders are batched together.
+        with contextlib.ExitStack() as in_use, contextlib.ExitStack() as locked:
+            locked.enter_context(self.lock)
+            _, _, audio_to_coeff, animate_from_coeff = self.sad_talker.load_models(avatar.size, avatar.preprocess)
+
+            #audio2ceoff
+            batch = get_data(avatar.first_coeff, audio_path, self.sad_talker.device, ref_eyeblink_coeff_path=None,
+                             still=avatar.still_mode, use_blink=use_blink)
+            coeff = audio_to_coeff.generate(batch, save_dir, pose_style, None)
+
+            #coeff2video
+            data = get_facerender_data(coeff, avatar.crop_pic_path, avatar.first_coeff, audio_path, batch_size,
+                                       still_mode=avatar.still_mode, preprocess=avatar.preprocess, size=avatar.size,
+                                       expression_scale=exp_scale, source_data=avatar.source_data)
+            data['source'] = avatar.source
+            # every enhanced render loads its own restorer, keep them one at a time
+            under_lock = animate_from_coeff.scheduler is None or use_enhancer
+            if not under_lock:
+                # a request for other models may evict this facerender once the lock is released,
+                # its scheduler is only closed after this render
+                in_use.enter_context(animate_from_coeff.scheduler.hold())
+                locked.close()   # releases the lock
+
+            return_path = animate_from_coeff.generate(data, save_dir, avatar.pic_path, avatar.crop_info,
+                                                      enhancer='gfpgan' if use_enhancer else None,
+                                                      preprocess=avatar.preprocess, img_size=avatar.size, chunk_size=chunk_size)
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        return return_path
@@ -15,6 +15,7 @@ from facexlib.detection import init_detection_model
 
 from facexlib.utils import load_file_from_url
 from src.face3d.util.my_awing_arch import FAN
+from src.utils.videoio import VideoReader
 
 def init_alignment_model(model_name, half=False, device='cuda', model_rootpath=None):
     if model_name == 'awing_fan':
@@ -45,24 +46,31 @@ class KeypointExtractor():
         self.detector = init_alignment_model('awing_fan',device=device, model_rootpath=root_path)   
         self.det_net = init_detection_model('retinaface_resnet50', half=False,device=device, model_rootpath=root_path)
 
+    def iter_keypoints(self, images):
+        """
+        Landmarks of a stream of frames, a frame without face reuses the previous landmarks.
+        """
+        last_kp = None
+        for image in images:
+            current_kp = self.extract_keypoint(image)
+            # current_kp = self.detector.get_landmarks(np.array(image))
+            if np.mean(current_kp) == -1 and last_kp is not None:
+                current_kp = last_kp
+            last_kp = current_kp
+            yield current_kp
+
     def extract_keypoint(self, images, name=None, info=True):
-        if isinstance(images, list):
-            keypoints = []
+        if not isinstance(images, (Image.Image, np.ndarray)): # list or stream of frames
             if info:
                 i_range = tqdm(images,desc='landmark Det:')
             else:
                 i_range = images
 
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
-                # current_kp = self.detector.get_landmarks(np.array(image))
-                if np.mean(current_kp) == -1 and keypoints:
-                    keypoints.append(keypoints[-1])
-                else:
-                    keypoints.append(current_kp[None])
+            keypoints = [current_kp[None] for current_kp in self.iter_keypoints(i_range)]
 
             keypoints = np.concatenate(keypoints, 0)
-            np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
+            if name is not None:
+                np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
             while True:
@@ -99,18 +107,9 @@ class KeypointExtractor():
             return keypoints
 
 def read_video(filename):
-    frames = []
-    cap = cv2.VideoCapture(filename)
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = Image.fromarray(frame)
-            frames.append(frame)
-        else:
-            break
-    cap.release()
-    return frames
+    # frames are decoded lazily
+    for frame in VideoReader(filename, prefetch=16):
+        yield Image.fromarray(frame)
 
 def run(data):
     filename, opt, device = data
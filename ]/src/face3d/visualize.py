@@ -6,14 +6,15 @@ from src.face3d.models.facerecon_model import FaceReconModel
 import torch
 import subprocess, platform
 import scipy.io as scio
+from src.utils.coeff import load_coeff
 from tqdm import tqdm 
 
 # draft
 def gen_composed_video(args, device, first_frame_coeff, coeff_path, audio_path, save_path, exp_dim=64):
     
-    coeff_first = scio.loadmat(first_frame_coeff)['full_3dmm']
+    coeff_first = load_coeff(first_frame_coeff).full_3dmm
 
-    coeff_pred = scio.loadmat(coeff_path)['coeff_3dmm']
+    coeff_pred = load_coeff(coeff_path).coeff_3dmm
 
     coeff_full = np.repeat(coeff_first, coeff_pred.shape[0], axis=0) # 257
 
@@ -3,9 +3,6 @@ import cv2
 import yaml
 import numpy as np
 import warnings
-from skimage import img_as_ubyte
-import safetensors
-import safetensors.torch 
 warnings.filterwarnings('ignore')
 
 
@@ -16,13 +13,17 @@ import torchvision
 
 from src.facerender.modules.keypoint_detector import HEEstimator, KPDetector
 from src.facerender.modules.mapping import MappingNet
+from src.facerender.modules.fuse import fuse_for_inference
 from src.facerender.modules.generator import OcclusionAwareGenerator, OcclusionAwareSPADEGenerator
-from src.facerender.modules.make_animation import make_animation 
+from src.facerender.modules.make_animation import make_animation_iter, make_animation_coeff_iter, prepare_source, predictions_to_uint8
+from src.facerender.parallel_render import render_segments
+from src.facerender.scheduler import RenderScheduler
 
 from pydub import AudioSegment 
-from src.utils.face_enhancer import enhancer_generator_with_len, enhancer_list
-from src.utils.paste_pic import paste_pic
-from src.utils.videoio import save_video_with_watermark
+from src.utils.face_enhancer import enhancer_generator_no_len
+from src.utils.paste_pic import paste_pic_frames
+from src.utils.videoio import FFmpegVideoWriter
+from src.utils.safetensor_helper import load_safetensor, load_x_from_safetensor
 
 try:
     import webui  # in webui
@@ -32,7 +33,7 @@ except:
 
 class AnimateFromCoeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, fuse=False, backend='torch', onnx_dir=None):
 
         with open(sadtalker_path['facerender_yaml']) as f:
             config = yaml.safe_load(f)
@@ -80,33 +81,37 @@ class AnimateFromCoeff():
         self.generator.eval()
         self.he_estimator.eval()
         self.mapping.eval()
+
+        if fuse:
+            # batch norms folded into the convs, spectral norms baked (inference only)
+            for model in (self.generator, self.kp_extractor, self.mapping):
+                fuse_for_inference(model)
+
+        self.backend = backend
+        if backend == 'onnx':
+            # onnx runtime sessions with the interface of the torch modules, exported by scripts/export_onnx.py
+            from src.facerender.onnx_backend import OrtGenerator, OrtKPDetector, OrtMappingNet
+            if onnx_dir is None:
+                raise ValueError('the onnx backend needs the folder of the exported models (onnx_dir)')
+            self.generator = OrtGenerator(onnx_dir, device)
+            self.kp_extractor = OrtKPDetector(onnx_dir, device)
+            self.mapping = OrtMappingNet(onnx_dir, device)
          
         self.device = device
+        self.scheduler = None
     
     def load_cpk_facevid2vid_safetensor(self, checkpoint_path, generator=None, 
                         kp_detector=None, he_estimator=None,  
                         device="cpu"):
 
-        checkpoint = safetensors.torch.load_file(checkpoint_path)
+        checkpoint = load_safetensor(checkpoint_path)
 
         if generator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'generator' in k:
-                    x_generator[k.replace('generator.', '')] = v
-            generator.load_state_dict(x_generator)
+            generator.load_state_dict(load_x_from_safetensor(checkpoint, 'generator'))
         if kp_detector is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'kp_extractor' in k:
-                    x_generator[k.replace('kp_extractor.', '')] = v
-            kp_detector.load_state_dict(x_generator)
+            kp_detector.load_state_dict(load_x_from_safetensor(checkpoint, 'kp_extractor'))
         if he_estimator is not None:
-            x_generator = {}
-            for k,v in checkpoint.items():
-                if 'he_estimator' in k:
-                    x_generator[k.replace('he_estimator.', '')] = v
-            he_estimator.load_state_dict(x_generator)
+            he_estimator.load_state_dict(load_x_from_safetensor(checkpoint, 'he_estimator'))
         
         return None
 
@@ -154,59 +159,109 @@ class AnimateFromCoeff():
 
         return checkpoint['epoch']
 
-    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256):
-
-        source_image=x['source_image'].type(torch.FloatTensor)
-        source_semantics=x['source_semantics'].type(torch.FloatTensor)
-        target_semantics=x['target_semantics_list'].type(torch.FloatTensor) 
-        source_image=source_image.to(self.device)
-        source_semantics=source_semantics.to(self.device)
-        target_semantics=target_semantics.to(self.device)
+    def enable_scheduler(self, max_batch=16, max_wait=0.01):
+        """
+        Batch the frames of the concurrent frames()/generate() calls into the same generator calls 
+        (see RenderScheduler), for servers rendering several short clips at once.
+        """
+        if self.scheduler is None:
+            self.scheduler = RenderScheduler(self.generator, self.mapping, max_batch=max_batch, max_wait=max_wait)
+        return self.scheduler
+
+    def prepare_source(self, source_image, source_semantics):
+        """
+        Keypoints and encoded features of the source image, pass them as x['source'] 
+        to skip this work when the same image is rendered again.
+        """
+        source_image = source_image.type(torch.FloatTensor).to(self.device)
+        source_semantics = source_semantics.type(torch.FloatTensor).to(self.device)
+        return prepare_source(source_image, source_semantics, self.generator, self.kp_extractor, self.mapping)
+
+    def frames(self, x, crop_info, img_size=256, chunk_size=None, workers=1, frame_start=0, frame_end=None):
+        """
+        Render the video chunk by chunk and yield uint8 RGB frames, so the memory is 
+        bounded by chunk_size (default: the batch size) instead of the clip length.
+        workers > 1 renders segments of the clip in that many processes (see parallel_render).
+        With enable_scheduler, the frames are batched with the ones of the other concurrent calls.
+        frame_start/frame_end: only render this segment (single process, without the upfront windows)
+        """
+        source = x.get('source')
+        if source is None:
+            # every item of the batch holds the same source image
+            source = self.prepare_source(x['source_image'][:1], x['source_semantics'][:1])
         if 'yaw_c_seq' in x:
             yaw_c_seq = x['yaw_c_seq'].type(torch.FloatTensor)
-            yaw_c_seq = x['yaw_c_seq'].to(self.device)
+            yaw_c_seq = yaw_c_seq.to(self.device)
         else:
             yaw_c_seq = None
         if 'pitch_c_seq' in x:
             pitch_c_seq = x['pitch_c_seq'].type(torch.FloatTensor)
-            pitch_c_seq = x['pitch_c_seq'].to(self.device)
+            pitch_c_seq = pitch_c_seq.to(self.device)
         else:
             pitch_c_seq = None
         if 'roll_c_seq' in x:
             roll_c_seq = x['roll_c_seq'].type(torch.FloatTensor) 
-            roll_c_seq = x['roll_c_seq'].to(self.device)
+            roll_c_seq = roll_c_seq.to(self.device)
         else:
             roll_c_seq = None
 
-        frame_num = x['frame_num']
+        if chunk_size is None:
+            chunk_size = x['source_image'].shape[0]
+        if self.backend == 'onnx':
+            # the sessions can not be sent to other processes, onnx runtime uses all the cores by itself
+            workers = 1
+
+        if 'target_semantics_list' in x:
+            # windows built upfront, (bs, T, C, 27)
+            target_semantics=x['target_semantics_list'].type(torch.FloatTensor) 
+            target_semantics=target_semantics.to(self.device)
+            frame_iter = make_animation_iter(None, None, target_semantics,
+                                        self.generator, self.kp_extractor, self.mapping, 
+                                        yaw_c_seq, pitch_c_seq, roll_c_seq, chunk_size=chunk_size, source=source)
+            frame_iter = (predictions_to_uint8(predictions) for predictions in frame_iter)
+        elif self.scheduler is not None and workers == 1 and frame_start == 0 and frame_end is None:
+            # rendered by the scheduler thread together with the frames of the other jobs
+            target_coeff = x['target_coeff'].type(torch.FloatTensor).to(self.device)
+            frame_iter = self.scheduler.submit(source, target_coeff, x['semantic_radius'], 
+                                        *[seq.reshape(-1) if seq is not None else None for seq in (yaw_c_seq, pitch_c_seq, roll_c_seq)])
+        elif workers > 1:
+            target_coeff = x['target_coeff'].type(torch.FloatTensor).to(self.device)
+            camera_seqs = tuple(seq.reshape(-1) if seq is not None else None for seq in (yaw_c_seq, pitch_c_seq, roll_c_seq))
+            frame_iter = render_segments(self.generator, self.mapping, source, target_coeff, x['semantic_radius'], 
+                                        camera_seqs, chunk_size=chunk_size, workers=workers)
+        else:
+            # windows cut per chunk on the device, the (bs, T) camera seqs are in frame order once flattened
+            target_coeff = x['target_coeff'].type(torch.FloatTensor).to(self.device)
+            frame_iter = make_animation_coeff_iter(source, target_coeff, x['semantic_radius'], self.generator, self.mapping, 
+                                        yaw_c_seq.reshape(-1) if yaw_c_seq is not None else None, 
+                                        pitch_c_seq.reshape(-1) if pitch_c_seq is not None else None, 
+                                        roll_c_seq.reshape(-1) if roll_c_seq is not None else None, chunk_size=chunk_size,
+                                        frame_start=frame_start, frame_end=frame_end)
+            frame_iter = (predictions_to_uint8(predictions) for predictions in frame_iter)
+
+        frame_num = x['frame_num'] if frame_end is None else min(x['frame_num'], frame_end)
+        frame_num = frame_num - frame_start
+        ### the generated video is 256x256, so we keep the aspect ratio, 
+        original_size = crop_info[0]
 
-        predictions_video = make_animation(source_image, source_semantics, target_semantics,
-                                        self.generator, self.kp_extractor, self.he_estimator, self.mapping, 
-                                        yaw_c_seq, pitch_c_seq, roll_c_seq, use_exp = True)
+        rendered = 0
+        for result in frame_iter:
+            # the padding frames of the last batch are at the end
+            result = result[:frame_num-rendered]
+            rendered += result.shape[0]
 
-        predictions_video = predictions_video.reshape((-1,)+predictions_video.shape[2:])
-        predictions_video = predictions_video[:frame_num]
+            for result_i in result:
+                if original_size:
+                    result_i = cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) ))
+                yield result_i
 
-        video = []
-        for idx in range(predictions_video.shape[0]):
-            image = predictions_video[idx]
-            image = np.transpose(image.data.cpu().numpy(), [1, 2, 0]).astype(np.float32)
-            video.append(image)
-        result = img_as_ubyte(video)
+            if rendered >= frame_num:
+                break
 
-        ### the generated video is 256x256, so we keep the aspect ratio, 
-        original_size = crop_info[0]
-        if original_size:
-            result = [ cv2.resize(result_i,(img_size, int(img_size * original_size[1]/original_size[0]) )) for result_i in result ]
-        
-        video_name = x['video_name']  + '.mp4'
-        path = os.path.join(video_save_dir, 'temp_'+video_name)
-        
-        imageio.mimsave(path, result,  fps=float(25))
+    def generate(self, x, video_save_dir, pic_path, crop_info, enhancer=None, background_enhancer=None, preprocess='crop', img_size=256, chunk_size=None, render_workers=1):
+
+        frame_num = x['frame_num']
 
-        av_path = os.path.join(video_save_dir, video_name)
-        return_path = av_path 
-        
         audio_path =  x['audio_path'] 
         audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
         new_audio_path = os.path.join(video_save_dir, audio_name+'.wav')
@@ -219,39 +274,26 @@ class AnimateFromCoeff():
         word = word1[start_time:end_time]
         word.export(new_audio_path, format="wav")
 
-        save_video_with_watermark(path, new_audio_path, av_path, watermark= False)
-        print(f'The generated video is named {video_save_dir}/{video_name}') 
+        # rendering, paste back and enhancer are chained frame by frame, 
+        # and only the final video is encoded (together with the audio).
+        video_frames = self.frames(x, crop_info, img_size=img_size, chunk_size=chunk_size, workers=render_workers)
+        video_name = x['video_name']  + '.mp4'
 
         if 'full' in preprocess.lower():
-            # only add watermark to the full image.
-            video_name_full = x['video_name']  + '_full.mp4'
-            full_video_path = os.path.join(video_save_dir, video_name_full)
-            return_path = full_video_path
-            paste_pic(path, pic_path, crop_info, new_audio_path, full_video_path, extended_crop= True if 'ext' in preprocess.lower() else False)
-            print(f'The generated video is named {video_save_dir}/{video_name_full}') 
-        else:
-            full_video_path = av_path 
+            video_frames = paste_pic_frames(video_frames, pic_path, crop_info, extended_crop= True if 'ext' in preprocess.lower() else False)
+            video_name = x['video_name']  + '_full.mp4'
 
         #### paste back then enhancers
         if enhancer:
-            video_name_enhancer = x['video_name']  + '_enhanced.mp4'
-            enhanced_path = os.path.join(video_save_dir, 'temp_'+video_name_enhancer)
-            av_path_enhancer = os.path.join(video_save_dir, video_name_enhancer) 
-            return_path = av_path_enhancer
+            video_frames = enhancer_generator_no_len(video_frames, method=enhancer, bg_upsampler=background_enhancer)
+            video_name = x['video_name']  + '_enhanced.mp4'
+
+        return_path = os.path.join(video_save_dir, video_name)
+        with FFmpegVideoWriter(return_path, fps=25, audio_path=new_audio_path) as writer:
+            for frame in video_frames:
+                writer.write(frame)
+        print(f'The generated video is named {video_save_dir}/{video_name}') 
 
-            try:
-                enhanced_images_gen_with_len = enhancer_generator_with_len(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            except:
-                enhanced_images_gen_with_len = enhancer_list(full_video_path, method=enhancer, bg_upsampler=background_enhancer)
-                imageio.mimsave(enhanced_path, enhanced_images_gen_with_len, fps=float(25))
-            
-            save_video_with_watermark(enhanced_path, new_audio_path, av_path_enhancer, watermark= False)
-            print(f'The generated video is named {video_save_dir}/{video_name_enhancer}')
-            os.remove(enhanced_path)
-
-        os.remove(path)
         os.remove(new_audio_path)
 
         return return_path
-
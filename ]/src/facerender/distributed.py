@@ -0,0 +1,288 @@
+"""
+Render one long clip on several machines.
+
+    coordinator: submit_job() stores the renderer inputs of a clip in a job folder and publishes
+                 its frame segments in the queue
+    workers:     run_worker() claims segments, renders them (AnimateFromCoeff.frames with
+                 frame_start/frame_end) and encodes each one in its own mp4
+    merger:      merge_job() concatenates the encoded segments without re-encoding and muxes the audio
+
+The job folders and the queue database are expected on a filesystem shared by the nodes.
+SegmentQueue is a SQLite stand-in for a real broker, it has the small interface the other parts use.
+The semantic windows of a segment are cut from the coeffs of the whole clip, so the boundaries
+of the segments are seamless.
+"""
+import os, time, uuid, socket, sqlite3, shutil, threading, traceback
+import torch
+from contextlib import closing
+
+from pydub import AudioSegment
+
+from src.utils.paste_pic import paste_pic_frames
+from src.utils.face_enhancer import enhancer_generator_no_len
+from src.utils.videoio import FFmpegVideoWriter, concat_videos
+from src.utils.init_path import init_path
+
+# keys of the get_facerender_data output the workers need
+JOB_KEYS = ['target_coeff', 'semantic_radius', 'frame_num', 'video_name', 'yaw_c_seq', 'pitch_c_seq', 'roll_c_seq']
+
+
+class SegmentQueue():
+    """
+    Segments of the submitted jobs, claimed by the workers with a lease: the segment of a worker
+    that died is handed to another worker once its lease expired. A running worker renews its lease,
+    only the worker that holds the lease can complete or fail the segment.
+    """
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with closing(self._connect()) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, job_dir TEXT, num_segments INTEGER, '
+                         'status TEXT, created REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS segments (job_id TEXT, idx INTEGER, frame_start INTEGER, frame_end INTEGER, '
+                         'status TEXT, worker TEXT, lease_until REAL, attempts INTEGER, path TEXT, error TEXT, '
+                         'PRIMARY KEY (job_id, idx))')
+
+    def _connect(self):
+        # autocommit, the transactions are opened explicitly
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def publish(self, job_id, job_dir, segments):
+        """segments: list of (frame_start, frame_end)"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?)', (job_id, job_dir, len(segments), 'pending', time.time()))
+            conn.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, NULL, NULL, 0, NULL, NULL)',
+                             [(job_id, idx, start, end, 'pending') for idx, (start, end) in enumerate(segments)])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def claim(self, worker):
+        """
+        Returns the oldest pending (or expired) segment as a dict, None when there is nothing to do.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            # the write lock is taken before the select, two workers never get the same segment
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT s.*, j.job_dir FROM segments s JOIN jobs j ON s.job_id = j.job_id '
+                               "WHERE j.status != 'failed' AND (s.status = 'pending' OR (s.status = 'running' AND s.lease_until < ?)) "
+                               'ORDER BY j.created, s.idx LIMIT 1', (now,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("UPDATE segments SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                         'WHERE job_id = ? AND idx = ?', (worker, now + self.lease_seconds, row['job_id'], row['idx']))
+            conn.execute("UPDATE jobs SET status = 'running' WHERE job_id = ? AND status = 'pending'", (row['job_id'],))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        segment = dict(row)
+        segment['attempts'] += 1
+        return segment
+
+    def renew(self, job_id, idx, worker):
+        """extend the lease of a claimed segment, False when the worker does not hold it anymore"""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute("UPDATE segments SET lease_until = ? WHERE job_id = ? AND idx = ? AND worker = ? AND status = 'running'",
+                                  (time.time() + self.lease_seconds, job_id, idx, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, idx, worker, path):
+        """False when the lease of the worker expired and the segment was handed to another worker"""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute("UPDATE segments SET status = 'done', path = ?, lease_until = NULL "
+                                  "WHERE job_id = ? AND idx = ? AND worker = ? AND status = 'running'", (path, job_id, idx, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, idx, worker, error):
+        """the segment is retried until max_attempts, then the whole job is marked as failed"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT attempts FROM segments WHERE job_id = ? AND idx = ? AND worker = ? AND status = 'running'",
+                               (job_id, idx, worker)).fetchone()
+            if row is None:
+                # the segment belongs to another worker now
+                conn.execute('COMMIT')
+                return
+            status = 'pending' if row['attempts'] < self.max_attempts else 'failed'
+            conn.execute('UPDATE segments SET status = ?, error = ?, lease_until = NULL WHERE job_id = ? AND idx = ?',
+                         (status, error, job_id, idx))
+            if status == 'failed':
+                conn.execute("UPDATE jobs SET status = 'failed' WHERE job_id = ?", (job_id,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def job(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def set_job_status(self, job_id, status):
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE jobs SET status = ? WHERE job_id = ?', (status, job_id))
+
+    def segments(self, job_id):
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT * FROM segments WHERE job_id = ? ORDER BY idx', (job_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def status(self, job_id):
+        """number of segments per status, e.g. {'done': 3, 'running': 2}"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM segments WHERE job_id = ? GROUP BY status', (job_id,)).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+def submit_job(queue, data, job_root, pic_path, crop_info, preprocess='crop', size=256,
+               enhancer=None, background_enhancer=None, segment_size=250, job_id=None):
+    """
+    data: get_facerender_data output of the clip
+    segment_size: frames per segment, 250 frames are 10 seconds of video
+    Returns the job id.
+    """
+    job_id = job_id if job_id is not None else str(uuid.uuid4())
+    job_dir = os.path.join(job_root, job_id)
+    os.makedirs(os.path.join(job_dir, 'segments'), exist_ok=True)
+
+    frame_num = data['frame_num']
+
+    # the audio of the rendered frames, muxed by the merger
+    sound = AudioSegment.from_file(data['audio_path'])
+    sound = sound.set_frame_rate(16000)[0:frame_num*1/25*1000]
+    sound.export(os.path.join(job_dir, 'audio.wav'), format="wav")
+
+    job = {k: data[k] for k in JOB_KEYS if k in data}
+    # the batch items hold the same source image, the camera seqs are in frame order once flattened
+    job['source_image'] = data['source_image'][:1]
+    job['source_semantics'] = data['source_semantics'][:1]
+    for k in ['yaw_c_seq', 'pitch_c_seq', 'roll_c_seq']:
+        if k in job:
+            job[k] = job[k].reshape(-1)
+    job['batch_size'] = data['source_image'].shape[0]
+    job.update({'crop_info': crop_info, 'preprocess': preprocess, 'size': size,
+                'enhancer': enhancer, 'background_enhancer': background_enhancer})
+    if 'full' in preprocess.lower():
+        # the renders are pasted back on the original image
+        job['pic_path'] = shutil.copy(pic_path, job_dir)
+    torch.save(job, os.path.join(job_dir, 'job.pt'))
+
+    segments = [(start, min(start + segment_size, frame_num)) for start in range(0, frame_num, segment_size)]
+    queue.publish(job_id, job_dir, segments)
+    print('Job %s: %d frames in %d segments' % (job_id, frame_num, len(segments)))
+    return job_id
+
+
+def render_segment(animate_from_coeff, job, frame_start, frame_end, save_path, chunk_size=None):
+    """Render frames [frame_start, frame_end) of the job into save_path, without audio."""
+    crop_info, preprocess = job['crop_info'], job['preprocess']
+    chunk_size = chunk_size if chunk_size is not None else job['batch_size']
+    video_frames = animate_from_coeff.frames(job, crop_info, img_size=job['size'], chunk_size=chunk_size,
+                                             frame_start=frame_start, frame_end=frame_end)
+    if 'full' in preprocess.lower():
+        video_frames = paste_pic_frames(video_frames, job['pic_path'], crop_info, extended_crop= True if 'ext' in preprocess.lower() else False)
+    if job['enhancer']:
+        video_frames = enhancer_generator_no_len(video_frames, method=job['enhancer'], bg_upsampler=job['background_enhancer'])
+
+    # every segment starts with a key frame and has the same encoding settings, they are concatenated as is
+    with FFmpegVideoWriter(save_path, fps=25) as writer:
+        for frame in video_frames:
+            writer.write(frame)
+    return save_path
+
+
+def _renew_lease(queue, job_id, idx, worker, stop):
+    """heartbeat of a rendering worker, renews its lease until stop is set or the lease is lost"""
+    while not stop.wait(queue.lease_seconds / 3):
+        if not queue.renew(job_id, idx, worker):
+            return
+
+
+def run_worker(queue, checkpoint_dir, config_dir, device, worker_id=None, chunk_size=None,
+               old_version=False, poll_interval=5, exit_when_idle=False):
+    """
+    Claim and render segments until stopped (or until the queue is empty with exit_when_idle).
+    The renderers are loaded on the first segment of each (size, preprocess) and kept.
+    """
+    from src.facerender.animate import AnimateFromCoeff
+
+    worker_id = worker_id if worker_id is not None else '%s-%d' % (socket.gethostname(), os.getpid())
+    renderers, jobs = {}, {}
+    while True:
+        segment = queue.claim(worker_id)
+        if segment is None:
+            if exit_when_idle:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        job_id, idx = segment['job_id'], segment['idx']
+        tmp_path = None
+        try:
+            if job_id not in jobs:
+                jobs.clear()
+                jobs[job_id] = torch.load(os.path.join(segment['job_dir'], 'job.pt'))
+            job = jobs[job_id]
+
+            # the full preprocess uses the same renderer as crop
+            key = (job['size'], 'full' in job['preprocess'].lower())
+            if key not in renderers:
+                sadtalker_paths = init_path(checkpoint_dir, config_dir, job['size'], old_version, job['preprocess'])
+                renderers[key] = AnimateFromCoeff(sadtalker_paths, device)
+
+            save_path = os.path.join(segment['job_dir'], 'segments', 'segment_%05d.mp4' % idx)
+            # a worker that lost its lease may still be writing the segment, each one writes its own file
+            tmp_path = os.path.join(segment['job_dir'], 'segments', 'segment_%05d.%s.tmp.mp4' % (idx, worker_id))
+            print('Worker %s: job %s, frames %d-%d' % (worker_id, job_id, segment['frame_start'], segment['frame_end']))
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_renew_lease, args=(queue, job_id, idx, worker_id, stop), daemon=True)
+            heartbeat.start()
+            try:
+                render_segment(renderers[key], job, segment['frame_start'], segment['frame_end'], tmp_path, chunk_size)
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            if queue.renew(job_id, idx, worker_id):
+                os.replace(tmp_path, save_path)
+                queue.complete(job_id, idx, worker_id, save_path)
+            else:
+                print('Worker %s: lost the lease of job %s segment %d' % (worker_id, job_id, idx))
+                os.remove(tmp_path)
+        except Exception:
+            traceback.print_exc()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            queue.fail(job_id, idx, worker_id, traceback.format_exc())
+
+
+def merge_job(queue, job_id, save_path=None):
+    """
+    Concatenate the segments of a finished job and mux the audio.
+    Returns the video path, None while segments are not rendered yet.
+    """
+    job = queue.job(job_id)
+    if job is None:
+        raise ValueError('unknown job %s' % job_id)
+    if job['status'] == 'failed':
+        raise RuntimeError('job %s failed' % job_id)
+
+    segments = queue.segments(job_id)
+    if any(segment['status'] != 'done' for segment in segments):
+        return None
+
+    job_dir = job['job_dir']
+    if save_path is None:
+        save_path = os.path.join(job_dir, torch.load(os.path.join(job_dir, 'job.pt'))['video_name'] + '.mp4')
+    concat_videos([segment['path'] for segment in segments], save_path, audio_path=os.path.join(job_dir, 'audio.wav'))
+    queue.set_job_status(job_id, 'merged')
+    print('The generated video is named:', save_path)
+    return save_path
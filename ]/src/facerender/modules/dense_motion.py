@@ -39,17 +39,14 @@ class DenseMotionNetwork(nn.Module):
         
         # if 'jacobian' in kp_driving:
         if 'jacobian' in kp_driving and kp_driving['jacobian'] is not None:
-            jacobian = torch.matmul(kp_source['jacobian'], torch.inverse(kp_driving['jacobian']))
-            jacobian = jacobian.unsqueeze(-3).unsqueeze(-3).unsqueeze(-3)
-            jacobian = jacobian.repeat(1, 1, d, h, w, 1, 1)
-            coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
-            coordinate_grid = coordinate_grid.squeeze(-1)                  
+            jacobian = torch.matmul(kp_source['jacobian'], torch.inverse(kp_driving['jacobian']))     # (bs, num_kp, 3, 3)
+            coordinate_grid = torch.einsum('bkij,bkdhwj->bkdhwi', jacobian, coordinate_grid)
 
 
         driving_to_source = coordinate_grid + kp_source['value'].view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
 
         #adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, -1, -1, -1, -1, -1)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)                #bs num_kp+1 d h w 3
         
         # sparse_motions = driving_to_source
@@ -57,12 +54,12 @@ class DenseMotionNetwork(nn.Module):
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3) !!!!
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
+        bs, c, d, h, w = feature.shape
+        # the num_kp+1 grids are stacked along the depth and sampled from the same feature in one call, 
+        # the feature is not repeated per keypoint
+        sparse_motions = sparse_motions.reshape((bs, (self.num_kp+1) * d, h, w, -1))                   # (bs, (num_kp+1)*d, h, w, 3)
+        sparse_deformed = F.grid_sample(feature, sparse_motions)                                        # (bs, c, (num_kp+1)*d, h, w)
+        sparse_deformed = sparse_deformed.view((bs, c, self.num_kp+1, d, h, w)).transpose(1, 2)         # (bs, num_kp+1, c, d, h, w)
         return sparse_deformed
 
     def create_heatmap_representations(self, feature, kp_driving, kp_source):
@@ -101,14 +98,12 @@ class DenseMotionNetwork(nn.Module):
         mask = self.mask(prediction)
         mask = F.softmax(mask, dim=1)
         out_dict['mask'] = mask
-        mask = mask.unsqueeze(2)                                   # (bs, num_kp+1, 1, d, h, w)
         
         zeros_mask = torch.zeros_like(mask)   
-        mask = torch.where(mask < 1e-3, zeros_mask, mask) 
+        mask = torch.where(mask < 1e-3, zeros_mask, mask)          # (bs, num_kp+1, d, h, w)
 
-        sparse_motion = sparse_motion.permute(0, 1, 5, 2, 3, 4)    # (bs, num_kp+1, 3, d, h, w)
-        deformation = (sparse_motion * mask).sum(dim=1)            # (bs, 3, d, h, w)
-        deformation = deformation.permute(0, 2, 3, 4, 1)           # (bs, d, h, w, 3)
+        # weighted sum of the sparse motions without the (bs, num_kp+1, 3, d, h, w) product
+        deformation = torch.einsum('bkdhwc,bkdhw->bdhwc', sparse_motion, mask)     # (bs, d, h, w, 3)
 
         out_dict['deformation'] = deformation
 
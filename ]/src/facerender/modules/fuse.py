@@ -0,0 +1,88 @@
+"""
+Inference-only simplification of the facerender modules, applied after the checkpoints are loaded:
+
+    - batch norms that follow a conv are folded into the conv weights and replaced by nn.Identity
+    - the other (pre-activation) synchronized batch norms become plain nn.BatchNorm layers
+    - the spectral norm of the SPADE blocks is baked into the conv weights
+
+The fused modules give the same outputs as the eval modules (up to float rounding),
+they can not be trained anymore. See scripts/compare_fused_facerender.py.
+"""
+import torch
+from torch import nn
+from torch.nn.utils.spectral_norm import SpectralNorm
+
+from src.facerender.sync_batchnorm import SynchronizedBatchNorm1d, SynchronizedBatchNorm2d, SynchronizedBatchNorm3d
+from src.facerender.modules.util import ResBottleneck, UpBlock2d, UpBlock3d, DownBlock2d, DownBlock3d, SameBlock2d, Decoder
+from src.facerender.modules.dense_motion import DenseMotionNetwork
+
+# (conv, norm) attributes where the norm is applied right after the conv
+FOLD_PAIRS = {
+    ResBottleneck: [('conv1', 'norm1'), ('conv2', 'norm2'), ('conv3', 'norm3'), ('skip', 'norm4')],
+    UpBlock2d: [('conv', 'norm')],
+    UpBlock3d: [('conv', 'norm')],
+    DownBlock2d: [('conv', 'norm')],
+    DownBlock3d: [('conv', 'norm')],
+    SameBlock2d: [('conv', 'norm')],
+    Decoder: [('conv', 'norm')],
+    DenseMotionNetwork: [('compress', 'norm')],
+}
+
+BATCHNORMS = {SynchronizedBatchNorm1d: nn.BatchNorm1d, SynchronizedBatchNorm2d: nn.BatchNorm2d, SynchronizedBatchNorm3d: nn.BatchNorm3d}
+
+
+@torch.no_grad()
+def fold_batchnorm(conv, norm):
+    """conv(x) followed by norm in eval mode == conv'(x), updates conv in place"""
+    scale = torch.rsqrt(norm.running_var + norm.eps)
+    shift = -norm.running_mean * scale
+    if norm.affine:
+        scale = scale * norm.weight
+        shift = shift * norm.weight + norm.bias
+
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(norm.running_mean)
+    conv.weight.copy_(conv.weight * scale.view((-1,) + (1,) * (conv.weight.dim() - 1)))
+    conv.bias = nn.Parameter(bias * scale + shift, requires_grad=False)
+    return conv
+
+
+def plain_batchnorm(norm):
+    """the same layer as a torch BatchNorm"""
+    plain = BATCHNORMS[type(norm)](norm.num_features, eps=norm.eps, momentum=norm.momentum, affine=norm.affine)
+    plain.load_state_dict(norm.state_dict())
+    return plain.to(norm.running_mean.device).eval()
+
+
+def remove_spectral_norms(model):
+    for module in model.modules():
+        for hook in list(module._forward_pre_hooks.values()):
+            if isinstance(hook, SpectralNorm):
+                # the eval weight, without power iteration
+                nn.utils.remove_spectral_norm(module, hook.name)
+
+
+def fuse_for_inference(model):
+    """
+    Fuse a loaded OcclusionAwareSPADEGenerator, KPDetector, MappingNet or DenseMotionNetwork in place.
+    Returns the model in eval mode.
+    """
+    model.eval()
+    remove_spectral_norms(model)
+
+    for module in list(model.modules()):
+        for conv_name, norm_name in FOLD_PAIRS.get(type(module), []):
+            conv, norm = getattr(module, conv_name, None), getattr(module, norm_name, None)
+            if conv is None or not isinstance(norm, nn.modules.batchnorm._BatchNorm):
+                continue
+            fold_batchnorm(conv, norm)
+            setattr(module, norm_name, nn.Identity())
+
+    # the batch norms that are not preceded by a conv (ResBlock2d/3d)
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if type(child) in BATCHNORMS:
+                setattr(module, name, plain_batchnorm(child))
+
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
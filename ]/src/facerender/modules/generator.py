@@ -67,8 +67,8 @@ class OcclusionAwareGenerator(nn.Module):
             deformation = deformation.permute(0, 2, 3, 4, 1)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        # Encoding (downsampling) part, only depends on the source image
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -76,10 +76,17 @@ class OcclusionAwareGenerator(nn.Module):
         bs, c, h, w = out.shape
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
+        if self.dense_motion_network is None:
+            # without motion the decoder gets the output of self.second, the 3d resblocks are not used
+            return feature_3d
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
 
+    def warp_decode(self, feature_3d, kp_driving, kp_source):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
+        bs, c, d, h, w = feature_3d.shape
+        out = feature_3d.view(bs, c*d, h, w)
         if self.dense_motion_network is not None:
             dense_motion = self.dense_motion_network(feature=feature_3d, kp_driving=kp_driving,
                                                      kp_source=kp_source)
@@ -116,6 +123,10 @@ class OcclusionAwareGenerator(nn.Module):
 
         return output_dict
 
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.warp_decode(feature_3d, kp_driving=kp_driving, kp_source=kp_source)
+
 
 class SPADEDecoder(nn.Module):
     def __init__(self):
@@ -207,8 +218,8 @@ class OcclusionAwareSPADEGenerator(nn.Module):
             deformation = deformation.permute(0, 2, 3, 4, 1)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
-        # Encoding (downsampling) part
+    def encode_source(self, source_image):
+        # Encoding (downsampling) part, only depends on the source image
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
@@ -216,10 +227,17 @@ class OcclusionAwareSPADEGenerator(nn.Module):
         bs, c, h, w = out.shape
         # print(out.shape)
         feature_3d = out.view(bs, self.reshape_channel, self.reshape_depth, h ,w) 
+        if self.dense_motion_network is None:
+            # without motion the decoder gets the output of self.second, the 3d resblocks are not used
+            return feature_3d
         feature_3d = self.resblocks_3d(feature_3d)
+        return feature_3d
 
+    def warp_decode(self, feature_3d, kp_driving, kp_source):
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
+        bs, c, d, h, w = feature_3d.shape
+        out = feature_3d.view(bs, c*d, h, w)
         if self.dense_motion_network is not None:
             dense_motion = self.dense_motion_network(feature=feature_3d, kp_driving=kp_driving,
                                                      kp_source=kp_source)
@@ -252,4 +270,8 @@ class OcclusionAwareSPADEGenerator(nn.Module):
 
         output_dict["prediction"] = out
         
-        return output_dict
\ No newline at end of file
+        return output_dict
+
+    def forward(self, source_image, kp_driving, kp_source):
+        feature_3d = self.encode_source(source_image)
+        return self.warp_decode(feature_3d, kp_driving=kp_driving, kp_source=kp_source)
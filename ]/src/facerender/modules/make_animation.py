@@ -97,18 +97,138 @@ def keypoint_transformation(kp_canonical, he, wo_exp=False):
 
     return {'value': kp_transformed}
 
+def driving_keypoints(kp_canonical, target_semantics, mapping,
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None):
+    """
+    Run the mapping net and the keypoint transformation over all frames in one call.
+    target_semantics: (bs, T, coeff_nc, 2*semantic_radius+1), returns (bs*T, num_kp, 3) keypoints
+    in the order of target_semantics.reshape(bs*T, ...)
+    """
+    bs, num_frames = target_semantics.shape[:2]
+    he_driving = mapping(target_semantics.reshape((bs*num_frames,) + target_semantics.shape[2:]))
+    if yaw_c_seq is not None:
+        he_driving['yaw_in'] = yaw_c_seq.reshape(bs*num_frames)
+    if pitch_c_seq is not None:
+        he_driving['pitch_in'] = pitch_c_seq.reshape(bs*num_frames)
+    if roll_c_seq is not None:
+        he_driving['roll_in'] = roll_c_seq.reshape(bs*num_frames)
+
+    kp_canonical_frames = {'value': kp_canonical['value'].repeat_interleave(num_frames, dim=0)}
+    return keypoint_transformation(kp_canonical_frames, he_driving)
+
+
+@torch.no_grad()
+def prepare_source(source_image, source_semantics, generator, kp_detector, mapping):
+    """
+    Everything the renderer derives from the source image, it does not depend on the audio.
+    """
+    kp_canonical = kp_detector(source_image)
+    he_source = mapping(source_semantics)
+    kp_source = keypoint_transformation(kp_canonical, he_source)
+    source_feature = generator.encode_source(source_image)
+    return {'kp_canonical': kp_canonical, 'kp_source': kp_source, 'source_feature': source_feature}
+
+
+@torch.no_grad()
+def make_animation_iter(source_image, source_semantics, target_semantics,
+                            generator, kp_detector, mapping, 
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, chunk_size=1, source=None):
+    """
+    Generator version of the vectorized make_animation, yields (chunk_size, 3, H, W) predictions 
+    in frame order, i.e. the order of target_semantics.reshape(bs*T, ...)
+    source: precomputed prepare_source output, source_image/source_semantics are then unused
+    """
+    if source is None:
+        source = prepare_source(source_image, source_semantics, generator, kp_detector, mapping)
+
+    bs, num_frames = target_semantics.shape[:2]
+    kp_canonical, kp_source, source_feature = source['kp_canonical'], source['kp_source'], source['source_feature']
+    if source_feature.shape[0] != bs:
+        # a single source for the whole batch, expand is a view
+        kp_canonical = {'value': kp_canonical['value'].expand(bs, -1, -1)}
+        kp_source = {'value': kp_source['value'].expand(bs, -1, -1)}
+        source_feature = source_feature.expand((bs,) + source_feature.shape[1:])
+
+    kp_driving = driving_keypoints(kp_canonical, target_semantics, mapping,
+                                    yaw_c_seq, pitch_c_seq, roll_c_seq)
+    source_idx = torch.arange(bs, device=source_feature.device).repeat_interleave(num_frames)
+    for start in tqdm(range(0, bs*num_frames, chunk_size), 'Face Renderer:'):
+        idx = source_idx[start:start+chunk_size]
+        out = generator.warp_decode(source_feature[idx],
+                                    kp_source={'value': kp_source['value'][idx]},
+                                    kp_driving={'value': kp_driving['value'][start:start+chunk_size]})
+        yield out['prediction']
+
+
+def target_windows(target_coeff, start, end, semantic_radius):
+    """
+    Semantic windows of frames [start, end) gathered from the (T, C) target coeffs on their device,
+    (end-start, C, 2*semantic_radius+1), same as transform_semantic_target.
+    """
+    num_frames = target_coeff.shape[0]
+    index = torch.arange(start, end, device=target_coeff.device)[:, None] + \
+            torch.arange(-semantic_radius, semantic_radius+1, device=target_coeff.device)[None]
+    index = index.clamp(0, num_frames-1)
+    return target_coeff[index].transpose(1, 2)
+
+
+def predictions_to_uint8(predictions):
+    """
+    (n, 3, H, W) float predictions to (n, H, W, 3) uint8 numpy frames, same as img_as_ubyte
+    """
+    result = (predictions * 255).round().clamp(0, 255).to(torch.uint8)
+    return result.permute(0, 2, 3, 1).cpu().numpy()
+
+
+@torch.no_grad()
+def make_animation_coeff_iter(source, target_coeff, semantic_radius, generator, mapping,
+                            yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, chunk_size=1,
+                            frame_start=0, frame_end=None, progress=True):
+    """
+    Same as make_animation_iter with the target windows cut lazily per chunk from the 
+    (T, C) target coeffs, the (T, C, 2*semantic_radius+1) windows never exist as a whole.
+    source: prepare_source output of one source image, the yaw/pitch/roll seqs are in frame order.
+    frame_start/frame_end: only render this segment of the clip
+    """
+    num_frames = target_coeff.shape[0]
+    frame_end = num_frames if frame_end is None else min(frame_end, num_frames)
+    kp_canonical, kp_source, source_feature = source['kp_canonical'], source['kp_source'], source['source_feature']
+    starts = range(frame_start, frame_end, chunk_size)
+    for start in (tqdm(starts, 'Face Renderer:') if progress else starts):
+        end = min(start+chunk_size, frame_end)
+        target_semantics = target_windows(target_coeff, start, end, semantic_radius).unsqueeze(0)   # 1 n C 27
+        kp_driving = driving_keypoints(kp_canonical, target_semantics, mapping,
+                                        yaw_c_seq[start:end] if yaw_c_seq is not None else None,
+                                        pitch_c_seq[start:end] if pitch_c_seq is not None else None,
+                                        roll_c_seq[start:end] if roll_c_seq is not None else None)
+        out = generator.warp_decode(source_feature[:1].expand((end-start,) + source_feature.shape[1:]),
+                                    kp_source={'value': kp_source['value'][:1].expand(end-start, -1, -1)},
+                                    kp_driving=kp_driving)
+        yield out['prediction']
 
 
 def make_animation(source_image, source_semantics, target_semantics,
                             generator, kp_detector, he_estimator, mapping, 
                             yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None,
-                            use_exp=True, use_half=False):
+                            use_exp=True, use_half=False, chunk_size=None):
+    if chunk_size is not None:
+        # vectorized mode: keypoints for the whole clip at once, then the generator 
+        # consumes chunk_size frames per call whatever the batch size is.
+        bs, num_frames = target_semantics.shape[:2]
+        predictions = list(make_animation_iter(source_image, source_semantics, target_semantics,
+                                                generator, kp_detector, mapping,
+                                                yaw_c_seq, pitch_c_seq, roll_c_seq, chunk_size=chunk_size))
+        predictions_ts = torch.cat(predictions, dim=0)
+        return predictions_ts.view((bs, num_frames) + predictions_ts.shape[1:])
+
     with torch.no_grad():
         predictions = []
 
         kp_canonical = kp_detector(source_image)
         he_source = mapping(source_semantics)
         kp_source = keypoint_transformation(kp_canonical, he_source)
+        # the source image is the same for every frame, encode it only once
+        source_feature = generator.encode_source(source_image)
     
         for frame_idx in tqdm(range(target_semantics.shape[1]), 'Face Renderer:'):
             # still check the dimension
@@ -125,7 +245,7 @@ def make_animation(source_image, source_semantics, target_semantics,
             kp_driving = keypoint_transformation(kp_canonical, he_driving)
                 
             kp_norm = kp_driving
-            out = generator(source_image, kp_source=kp_source, kp_driving=kp_norm)
+            out = generator.warp_decode(source_feature, kp_source=kp_source, kp_driving=kp_norm)
             '''
             source_image_new = out['prediction'].squeeze(1)
             kp_canonical_new =  kp_detector(source_image_new)
@@ -16,19 +16,20 @@ def kp2gaussian(kp, spatial_size, kp_variance):
     mean = kp['value']
 
     coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
-    number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
+    # the squared distance is separable, the per axis terms are broadcast instead of 
+    # repeating the (d, h, w, 3) grid per keypoint
+    xx = coordinate_grid[0, 0, :, 0]    # w
+    yy = coordinate_grid[0, :, 0, 1]    # h
+    zz = coordinate_grid[:, 0, 0, 2]    # d
 
     # Preprocess kp shape
-    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
-    mean = mean.view(*shape)
+    mean = mean.unsqueeze(-2).unsqueeze(-2).unsqueeze(-2)      # (..., 1, 1, 1, 3)
 
-    mean_sub = (coordinate_grid - mean)
+    dist = (xx.view(1, 1, -1) - mean[..., 0]) ** 2 + \
+           (yy.view(1, -1, 1) - mean[..., 1]) ** 2 + \
+           (zz.view(-1, 1, 1) - mean[..., 2]) ** 2             # (..., d, h, w)
 
-    out = torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+    out = torch.exp(-0.5 * dist / kp_variance)
 
     return out
 
@@ -51,7 +52,23 @@ def make_coordinate_grid_2d(spatial_size, type):
     return meshed
 
 
+# (spatial_size, type, cuda device) -> grid, the grids are shared, do not modify them in place
+_coordinate_grids = {}
+
 def make_coordinate_grid(spatial_size, type):
+    """
+    Create a meshgrid [-1,1] x [-1,1] x [-1,1] of given spatial_size, (d, h, w, 3).
+    The grid is built once per size/type/device and cached.
+    """
+    key = (tuple(spatial_size), type, torch.cuda.current_device() if 'cuda' in type else None)
+    grid = _coordinate_grids.get(key)
+    if grid is None:
+        grid = _make_coordinate_grid(spatial_size, type)
+        _coordinate_grids[key] = grid
+    return grid
+
+
+def _make_coordinate_grid(spatial_size, type):
     d, h, w = spatial_size
     x = torch.arange(w).type(type)
     y = torch.arange(h).type(type)
@@ -0,0 +1,107 @@
+"""
+ONNX Runtime execution of the face renderer. The models are exported by scripts/export_onnx.py,
+the classes below have the interface of the torch modules AnimateFromCoeff calls
+(mapping(x), kp_extractor(x), generator.encode_source(x), generator.warp_decode(...)).
+"""
+import os
+import numpy as np
+import torch
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# file name -> (input names, output names) of the exported graphs
+ONNX_MODELS = {
+    'mapping': (['input_3dmm'], ['yaw', 'pitch', 'roll', 't', 'exp']),
+    'kp_detector': (['source_image'], ['value']),
+    'encode_source': (['source_image'], ['feature_3d']),
+    'warp_decode': (['feature_3d', 'kp_source', 'kp_driving'], ['prediction']),
+}
+
+
+def default_onnx_dir(checkpoint_dir, size=256, preprocess='crop'):
+    """the full preprocess uses other facerender checkpoints than crop/resize"""
+    return os.path.join(checkpoint_dir, 'onnx_%d_%s' % (size, 'full' if 'full' in preprocess.lower() else 'crop'))
+
+
+class OrtSession():
+    """
+    An onnx graph run with IO binding on the torch tensors: the inputs are read in place and the outputs
+    are written into torch tensors preallocated on the session device, nothing goes through the host.
+    """
+    def __init__(self, path, input_names, output_names, device='cpu', num_threads=None):
+        if ort is None:
+            raise ImportError('the onnx backend needs onnxruntime (pip install onnxruntime or onnxruntime-gpu)')
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if 'cuda' in str(device) else ['CPUExecutionProvider']
+        self.session = ort.InferenceSession(path, sess_options=options, providers=providers)
+        self.input_names = input_names
+        self.output_names = output_names
+        self.device = torch.device(device)
+        # only the batch axis is dynamic (scripts/export_onnx.py), the outputs are allocated from the other dims
+        shapes = {out.name: out.shape[1:] for out in self.session.get_outputs()}
+        for name in output_names:
+            if not all(isinstance(dim, int) for dim in shapes[name]):
+                raise ValueError('%s: output %s has the shape %s, only the first (batch) axis may be dynamic. '
+                                 'Export the models with scripts/export_onnx.py' % (path, name, ['batch'] + list(shapes[name])))
+        self.output_shapes = [shapes[name] for name in output_names]
+
+    def __call__(self, *inputs):
+        binding = self.session.io_binding()
+        device_type = 'cuda' if self.device.type == 'cuda' else 'cpu'
+        device_id = self.device.index or 0
+
+        # keep the contiguous float inputs alive until the run is over, ORT reads their memory
+        inputs = [x.to(self.device, torch.float32).contiguous() for x in inputs]
+        for name, x in zip(self.input_names, inputs):
+            binding.bind_input(name, device_type, device_id, np.float32, tuple(x.shape), x.data_ptr())
+        batch_size = inputs[0].shape[0]
+        outputs = [torch.empty((batch_size,) + tuple(shape), dtype=torch.float32, device=self.device) for shape in self.output_shapes]
+        for name, out in zip(self.output_names, outputs):
+            binding.bind_output(name, device_type, device_id, np.float32, tuple(out.shape), out.data_ptr())
+
+        if self.device.type == 'cuda':
+            # ORT runs on its own cuda stream, the torch kernels writing the inputs have to be done
+            torch.cuda.synchronize(self.device)
+        self.session.run_with_iobinding(binding)
+        # and the outputs are written before torch reads them
+        binding.synchronize_outputs()
+        return outputs
+
+
+class OrtMappingNet():
+    def __init__(self, onnx_dir, device, num_threads=None):
+        self.session = OrtSession(os.path.join(onnx_dir, 'mapping.onnx'), *ONNX_MODELS['mapping'], device, num_threads)
+
+    def __call__(self, input_3dmm):
+        return dict(zip(self.session.output_names, self.session(input_3dmm)))
+
+
+class OrtKPDetector():
+    def __init__(self, onnx_dir, device, num_threads=None):
+        self.session = OrtSession(os.path.join(onnx_dir, 'kp_detector.onnx'), *ONNX_MODELS['kp_detector'], device, num_threads)
+
+    def __call__(self, x):
+        return {'value': self.session(x)[0]}
+
+
+class OrtGenerator():
+    """the split generator of OcclusionAwareSPADEGenerator, encode_source and warp_decode"""
+    def __init__(self, onnx_dir, device, num_threads=None):
+        self.encoder = OrtSession(os.path.join(onnx_dir, 'encode_source.onnx'), *ONNX_MODELS['encode_source'], device, num_threads)
+        self.decoder = OrtSession(os.path.join(onnx_dir, 'warp_decode.onnx'), *ONNX_MODELS['warp_decode'], device, num_threads)
+
+    def encode_source(self, source_image):
+        return self.encoder(source_image)[0]
+
+    def warp_decode(self, feature_3d, kp_driving, kp_source):
+        return {'prediction': self.decoder(feature_3d, kp_source['value'], kp_driving['value'])[0]}
+
+    def __call__(self, source_image, kp_driving, kp_source):
+        return self.warp_decode(self.encode_source(source_image), kp_driving=kp_driving, kp_source=kp_source)
@@ -0,0 +1,89 @@
+import queue as queue_module
+import traceback
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from src.facerender.modules.make_animation import make_animation_coeff_iter, predictions_to_uint8
+
+
+def _render_worker(models, source, target_coeff, semantic_radius, camera_seqs, segments, chunk_size, num_threads, out_queue):
+    """
+    Render the given segments in order, each one as a list of uint8 chunks followed by None.
+    """
+    try:
+        torch.set_num_threads(num_threads)
+        for start, end in segments:
+            for predictions in make_animation_coeff_iter(source, target_coeff, semantic_radius, 
+                                        models['generator'], models['mapping'], *camera_seqs, 
+                                        chunk_size=chunk_size, frame_start=start, frame_end=end, progress=False):
+                out_queue.put(predictions_to_uint8(predictions))
+            out_queue.put(None)
+    except Exception:
+        out_queue.put(traceback.format_exc())
+
+
+def _get(queue, process, poll_interval):
+    """
+    queue.get that fails when the worker died without reporting (killed by the OOM killer, segfault)
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except queue_module.Empty:
+            if process.is_alive():
+                continue
+        # what the worker put before exiting is still delivered
+        try:
+            return queue.get(timeout=1)
+        except queue_module.Empty:
+            raise RuntimeError('render worker exited with code %s' % process.exitcode)
+
+
+def render_segments(generator, mapping, source, target_coeff, semantic_radius, camera_seqs=(None, None, None),
+                    chunk_size=1, workers=2, segment_size=None, max_queued_segments=2, poll_interval=5):
+    """
+    Split the clip in contiguous segments rendered by `workers` processes (round robin, 
+    so the workers progress together) and yield the (n, H, W, 3) uint8 chunks in frame order.
+    The models and inputs are moved to shared memory, the workers do not copy the weights.
+    Each worker queues at most max_queued_segments rendered segments ahead of the consumer.
+    """
+    num_frames = target_coeff.shape[0]
+    segment_size = segment_size or chunk_size*8
+    segments = [(start, min(start+segment_size, num_frames)) for start in range(0, num_frames, segment_size)]
+    workers = max(1, min(workers, len(segments)))
+
+    models = {'generator': generator.share_memory(), 'mapping': mapping.share_memory()}
+    source = {'kp_canonical': {'value': source['kp_canonical']['value'].share_memory_()}, 
+              'kp_source': {'value': source['kp_source']['value'].share_memory_()},
+              'source_feature': source['source_feature'].share_memory_()}
+    target_coeff = target_coeff.share_memory_()
+    camera_seqs = tuple(seq.share_memory_() if seq is not None else None for seq in camera_seqs)
+    # the intra-op threads are split between the workers
+    num_threads = max(1, torch.get_num_threads() // workers)
+
+    chunks_per_segment = (segment_size + chunk_size - 1) // chunk_size + 1
+    ctx = mp.get_context('spawn')
+    queues = [ctx.Queue(maxsize=chunks_per_segment*max_queued_segments) for _ in range(workers)]
+    processes = [ctx.Process(target=_render_worker, 
+                             args=(models, source, target_coeff, semantic_radius, camera_seqs, segments[i::workers], 
+                                   chunk_size, num_threads, queues[i]), daemon=True) 
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+
+    try:
+        for i in tqdm(range(len(segments)), 'Face Renderer:'):
+            queue, process = queues[i % workers], processes[i % workers]
+            while True:
+                item = _get(queue, process, poll_interval)
+                if item is None:
+                    break
+                if isinstance(item, str):
+                    raise RuntimeError('render worker failed:\n' + item)
+                yield item
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
@@ -0,0 +1,230 @@
+"""
+Dynamic batching of the face renderer across concurrent jobs.
+
+Every job submits its prepared source and target coeffs, a background thread fills each generator
+call with the pending frames of all the jobs (up to max_batch frames, waiting at most max_wait for
+more of them) and routes the rendered frames back to the job that asked for them.
+"""
+import time, queue, threading, traceback
+from contextlib import contextmanager
+import torch
+
+from src.facerender.modules.make_animation import driving_keypoints, target_windows, predictions_to_uint8
+
+
+class RenderJob():
+    """
+    A clip rendered by the scheduler, iterate it to get its (n, H, W, 3) uint8 frames in order.
+    """
+    def __init__(self, scheduler, source, target_coeff, semantic_radius, yaw_c_seq, pitch_c_seq, roll_c_seq, num_frames):
+        self.scheduler = scheduler
+        self.source = source
+        self.target_coeff = target_coeff
+        self.semantic_radius = semantic_radius
+        self.camera_seqs = (yaw_c_seq, pitch_c_seq, roll_c_seq)
+        self.num_frames = num_frames
+        self.cursor = 0         # next frame to schedule
+        self.cancelled = False
+        # bounded by the scheduler (max_queued), a slow consumer does not pile up frames
+        self.output = queue.Queue()
+
+    def remaining(self):
+        return self.num_frames - self.cursor
+
+    def close(self):
+        self.scheduler.cancel(self)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.output.get()
+                self.scheduler.notify()
+                if item is None:
+                    return
+                if isinstance(item, str):
+                    raise RuntimeError('render failed:\n' + item)
+                yield item
+        finally:
+            self.close()
+
+
+class RenderScheduler():
+    """
+    generator, mapping: the models of one AnimateFromCoeff, only the scheduler thread runs the generator.
+    max_batch: frames per generator call
+    max_wait: seconds the scheduler waits for other jobs to fill a batch
+    max_queued: rendered chunks kept per job before its frames are not scheduled anymore
+    """
+    def __init__(self, generator, mapping, max_batch=16, max_wait=0.01, max_queued=4):
+        self.generator = generator
+        self.mapping = mapping
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queued = max_queued
+
+        self.jobs = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.holders = 0        # callers between hold() and the end of their renders
+
+        # metrics
+        self.num_batches = 0
+        self.num_frames = 0
+        self.last_batch_fill = 0.
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, source, target_coeff, semantic_radius, yaw_c_seq=None, pitch_c_seq=None, roll_c_seq=None, num_frames=None):
+        """
+        source: prepare_source output of one source image, target_coeff: (T, C) on the render device,
+        the camera seqs are in frame order.
+        """
+        num_frames = target_coeff.shape[0] if num_frames is None else num_frames
+        job = RenderJob(self, source, target_coeff, semantic_radius, yaw_c_seq, pitch_c_seq, roll_c_seq, num_frames)
+        with self.cond:
+            if self.closed and self.holders == 0:
+                raise RuntimeError('the render scheduler is closed')
+            if num_frames <= 0:
+                # nothing to render, the scheduler would never end the job
+                job.output.put(None)
+                return job
+            self.jobs.append(job)
+            self.cond.notify_all()
+        return job
+
+    def cancel(self, job):
+        with self.cond:
+            job.cancelled = True
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self.cond.notify_all()
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    @contextmanager
+    def hold(self):
+        """the scheduler keeps taking the jobs of the holders after close(), it stops once they are done"""
+        with self.cond:
+            self.holders += 1
+        try:
+            yield self
+        finally:
+            with self.cond:
+                self.holders -= 1
+                self.cond.notify_all()
+
+    def close(self):
+        """stop once the holders are done and the submitted jobs are rendered"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def metrics(self):
+        with self.cond:
+            return {'active_jobs': len(self.jobs),
+                    'queue_depth': sum(job.remaining() for job in self.jobs),
+                    'batches': self.num_batches,
+                    'frames': self.num_frames,
+                    'batch_fill': self.num_frames / (self.num_batches * self.max_batch) if self.num_batches else 0.,
+                    'last_batch_fill': self.last_batch_fill}
+
+    def _ready_jobs(self):
+        return [job for job in self.jobs if job.remaining() > 0 and job.output.qsize() < self.max_queued]
+
+    def _plan(self):
+        """split max_batch frames between the ready jobs, even shares first then the leftover"""
+        ready = self._ready_jobs()
+        # rotate, the first submitted job is not always served first
+        k = self.num_batches % len(ready)
+        ready = ready[k:] + ready[:k]
+
+        budget = self.max_batch
+        share = max(1, budget // len(ready))
+        takes = []
+        for job in ready:
+            n = min(share, job.remaining(), budget)
+            takes.append(n)
+            budget -= n
+        for i, job in enumerate(ready):
+            extra = min(job.remaining() - takes[i], budget)
+            takes[i] += extra
+            budget -= extra
+
+        plan = []
+        for job, n in zip(ready, takes):
+            if n > 0:
+                plan.append((job, job.cursor, job.cursor + n))
+                job.cursor += n
+        return plan
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._ready_jobs():
+                    if self.closed and not self.jobs and self.holders == 0:
+                        return
+                    self.cond.wait()
+                # latency budget: give the other jobs a chance to fill the batch
+                deadline = time.time() + self.max_wait
+                while sum(job.remaining() for job in self._ready_jobs()) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self._ready_jobs():  # cancelled while waiting
+                    continue
+                plan = self._plan()
+
+            try:
+                results = self._render(plan)
+            except Exception:
+                error = traceback.format_exc()
+                with self.cond:
+                    for job, _, _ in plan:
+                        job.output.put(error)
+                        if job in self.jobs:
+                            self.jobs.remove(job)
+                continue
+
+            with self.cond:
+                for (job, start, end), frames in zip(plan, results):
+                    if job.cancelled:
+                        continue
+                    job.output.put(frames)
+                    if end >= job.num_frames:
+                        job.output.put(None)
+                        self.jobs.remove(job)
+
+    @torch.no_grad()
+    def _render(self, plan):
+        kp_driving, kp_source, source_feature = [], [], []
+        for job, start, end in plan:
+            n = end - start
+            # the keypoints are cheap, they are computed per job (the jobs may or may not have camera seqs)
+            target_semantics = target_windows(job.target_coeff, start, end, job.semantic_radius).unsqueeze(0)   # 1 n C 27
+            yaw_c_seq, pitch_c_seq, roll_c_seq = [seq[start:end] if seq is not None else None for seq in job.camera_seqs]
+            kp_canonical = {'value': job.source['kp_canonical']['value'][:1]}
+            kp_driving.append(driving_keypoints(kp_canonical, target_semantics, self.mapping,
+                                                yaw_c_seq, pitch_c_seq, roll_c_seq)['value'])
+            kp_source.append(job.source['kp_source']['value'][:1].expand(n, -1, -1))
+            source_feature.append(job.source['source_feature'][:1].expand((n,) + job.source['source_feature'].shape[1:]))
+
+        # one generator call for the frames of all the jobs
+        out = self.generator.warp_decode(torch.cat(source_feature), kp_source={'value': torch.cat(kp_source)},
+                                         kp_driving={'value': torch.cat(kp_driving)})
+        frames = predictions_to_uint8(out['prediction'])
+
+        counts = [end - start for _, start, end in plan]
+        with self.cond:
+            self.num_batches += 1
+            self.num_frames += sum(counts)
+            self.last_batch_fill = sum(counts) / self.max_batch
+
+        results, offset = [], 0
+        for n in counts:
+            results.append(frames[offset:offset+n])
+            offset += n
+        return results
@@ -6,6 +6,7 @@ import numpy as np
 import random
 import scipy.io as scio
 import src.utils.audio as audio
+from src.utils.coeff import load_coeff
 
 def crop_pad_audio(wav, audio_length):
     if len(wav) > audio_length:
@@ -48,46 +49,64 @@ def generate_blink_seq_randomly(num_frames):
             break
     return ratio
 
-def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True):
+def mel_window_index(num_frames, num_mel_frames, fps=25, syncnet_mel_step_size=16):
+    """
+    Index of the mel frames of every video frame, (num_frames, syncnet_mel_step_size),
+    the windows start 2 video frames before the current one and are clamped to the spectrogram.
+    """
+    start_idx = (80. * ((np.arange(num_frames) - 2) / float(fps))).astype(np.int64) # int() rounds toward zero too
+    seq = start_idx[:, None] + np.arange(syncnet_mel_step_size)[None]
+    return np.clip(seq, 0, num_mel_frames-1)
+
+def mel_windows(spec, num_frames, fps=25, syncnet_mel_step_size=16):
+    """
+    spec: (nframes, 80) numpy mel spectrogram, returns the (T, 80, 16) windows in one gather.
+    """
+    seq = mel_window_index(num_frames, spec.shape[0], fps, syncnet_mel_step_size)
+    return spec[seq].transpose(0, 2, 1)
+
+def mel_windows_torch(spec, num_frames, device, fps=25, syncnet_mel_step_size=16):
+    """
+    Same as mel_windows, only the spectrogram is copied to the device and the windows 
+    are gathered there, returns the (1, T, 1, 80, 16) model input.
+    """
+    spec = torch.as_tensor(spec, dtype=torch.float32).to(device)
+    seq = torch.from_numpy(mel_window_index(num_frames, spec.shape[0], fps, syncnet_mel_step_size)).to(device)
+    return spec[seq].transpose(1, 2).unsqueeze(1).unsqueeze(0)  # bs T 1 80 16
+
+def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, still=False, idlemode=False, length_of_audio=False, use_blink=True, torch_mel=False):
 
     syncnet_mel_step_size = 16
     fps = 25
 
-    pic_name = os.path.splitext(os.path.split(first_coeff_path)[-1])[0]
+    # the coeffs are CoeffResult objects or .mat paths
+    first_coeff = load_coeff(first_coeff_path)
+    pic_name = first_coeff.name
     audio_name = os.path.splitext(os.path.split(audio_path)[-1])[0]
 
     
     if idlemode:
         num_frames = int(length_of_audio * 25)
-        indiv_mels = np.zeros((num_frames, 80, 16))
+        indiv_mels = torch.zeros((1, num_frames, 1, 80, syncnet_mel_step_size), device=device) # bs T 1 80 16
     else:
         wav = audio.load_wav(audio_path, 16000) 
         wav_length, num_frames = parse_audio_length(len(wav), 16000, 25)
         wav = crop_pad_audio(wav, wav_length)
-        orig_mel = audio.melspectrogram(wav).T
-        spec = orig_mel.copy()         # nframes 80
-        indiv_mels = []
-
-        for i in tqdm(range(num_frames), 'mel:'):
-            start_frame_num = i-2
-            start_idx = int(80. * (start_frame_num / float(fps)))
-            end_idx = start_idx + syncnet_mel_step_size
-            seq = list(range(start_idx, end_idx))
-            seq = [ min(max(item, 0), orig_mel.shape[0]-1) for item in seq ]
-            m = spec[seq, :]
-            indiv_mels.append(m.T)
-        indiv_mels = np.asarray(indiv_mels)         # T 80 16
+        if torch_mel:
+            spec = audio.melspectrogram_torch(wav, device).T         # nframes 80
+        else:
+            orig_mel = audio.melspectrogram(wav).T
+            spec = orig_mel.copy()         # nframes 80
+        # the overlapping windows are gathered on the device, only the spectrogram is copied
+        indiv_mels = mel_windows_torch(spec, num_frames, device, fps, syncnet_mel_step_size)   # bs T 1 80 16
 
     ratio = generate_blink_seq_randomly(num_frames)      # T
-    source_semantics_path = first_coeff_path
-    source_semantics_dict = scio.loadmat(source_semantics_path)
-    ref_coeff = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
+    ref_coeff = first_coeff.coeff_3dmm[:1,:70]         #1 70
     ref_coeff = np.repeat(ref_coeff, num_frames, axis=0)
 
     if ref_eyeblink_coeff_path is not None:
         ratio[:num_frames] = 0
-        refeyeblink_coeff_dict = scio.loadmat(ref_eyeblink_coeff_path)
-        refeyeblink_coeff = refeyeblink_coeff_dict['coeff_3dmm'][:,:64]
+        refeyeblink_coeff = load_coeff(ref_eyeblink_coeff_path).coeff_3dmm[:,:64]
         refeyeblink_num_frames = refeyeblink_coeff.shape[0]
         if refeyeblink_num_frames<num_frames:
             div = num_frames//refeyeblink_num_frames
@@ -99,8 +118,6 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
 
         ref_coeff[:, :64] = refeyeblink_coeff[:num_frames, :64] 
     
-    indiv_mels = torch.FloatTensor(indiv_mels).unsqueeze(1).unsqueeze(0) # bs T 1 80 16
-
     if use_blink:
         ratio = torch.FloatTensor(ratio).unsqueeze(0)                       # bs T
     else:
@@ -108,7 +125,6 @@ def get_data(first_coeff_path, audio_path, device, ref_eyeblink_coeff_path, stil
                                # bs T
     ref_coeff = torch.FloatTensor(ref_coeff).unsqueeze(0)                # bs 1 70
 
-    indiv_mels = indiv_mels.to(device)
     ratio = ratio.to(device)
     ref_coeff = ref_coeff.to(device)
 
@@ -4,41 +4,56 @@ from PIL import Image
 from skimage import io, img_as_float32, transform
 import torch
 import scipy.io as scio
+from src.utils.coeff import load_coeff
 
-def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
-                        batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
-                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256):
-
-    semantic_radius = 13
-    video_name = os.path.splitext(os.path.split(coeff_path)[-1])[0]
-    txt_path = os.path.splitext(coeff_path)[0]
-
-    data={}
-
+def get_source_data(pic_path, first_coeff_path, preprocess='crop', size=256, semantic_radius=13):
+    """
+    The audio independent part of get_facerender_data, batch size 1.
+    """
     img1 = Image.open(pic_path)
     source_image = np.array(img1)
     source_image = img_as_float32(source_image)
     source_image = transform.resize(source_image, (size, size, 3))
     source_image = source_image.transpose((2, 0, 1))
     source_image_ts = torch.FloatTensor(source_image).unsqueeze(0)
-    source_image_ts = source_image_ts.repeat(batch_size, 1, 1, 1)
-    data['source_image'] = source_image_ts
- 
-    source_semantics_dict = scio.loadmat(first_coeff_path)
-    generated_dict = scio.loadmat(coeff_path)
 
-    if 'full' not in preprocess.lower():
-        source_semantics = source_semantics_dict['coeff_3dmm'][:1,:70]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
+    source_coeff = load_coeff(first_coeff_path).coeff_3dmm
 
+    if 'full' not in preprocess.lower():
+        source_semantics = source_coeff[:1,:70]         #1 70
     else:
-        source_semantics = source_semantics_dict['coeff_3dmm'][:1,:73]         #1 70
-        generated_3dmm = generated_dict['coeff_3dmm'][:,:70]
+        source_semantics = source_coeff[:1,:73]         #1 70
 
     source_semantics_new = transform_semantic_1(source_semantics, semantic_radius)
     source_semantics_ts = torch.FloatTensor(source_semantics_new).unsqueeze(0)
-    source_semantics_ts = source_semantics_ts.repeat(batch_size, 1, 1)
-    data['source_semantics'] = source_semantics_ts
+
+    return {'source_image': source_image_ts, 'source_semantics': source_semantics_ts, 'source_coeff': source_semantics}
+
+def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path, 
+                        batch_size, input_yaw_list=None, input_pitch_list=None, input_roll_list=None, 
+                        expression_scale=1.0, still_mode = False, preprocess='crop', size = 256, source_data=None, txt_path=None,
+                        build_windows=False):
+    """
+    coeff_path/first_coeff_path: CoeffResult objects or .mat paths
+    txt_path: also dump the target coeffs as text there (debug)
+    The renderer cuts the semantic windows of the target coeffs (data['target_coeff']) chunk by chunk, 
+    build_windows also builds all of them upfront in data['target_semantics_list'].
+    """
+
+    semantic_radius = 13
+    coeff = load_coeff(coeff_path)
+    video_name = coeff.name
+
+    data={}
+
+    # source_data: precomputed get_source_data output
+    if source_data is None:
+        source_data = get_source_data(pic_path, first_coeff_path, preprocess, size, semantic_radius)
+    data['source_image'] = source_data['source_image'].repeat(batch_size, 1, 1, 1)
+    data['source_semantics'] = source_data['source_semantics'].repeat(batch_size, 1, 1)
+    source_semantics = source_data['source_coeff']
+
+    generated_3dmm = coeff.coeff_3dmm[:,:70].copy()
 
     # target 
     generated_3dmm[:, :64] = generated_3dmm[:, :64] * expression_scale
@@ -49,27 +64,19 @@ def get_facerender_data(coeff_path, pic_path, first_coeff_path, audio_path,
     if still_mode:
         generated_3dmm[:, 64:] = np.repeat(source_semantics[:, 64:], generated_3dmm.shape[0], axis=0)
 
-    with open(txt_path+'.txt', 'w') as f:
-        for coeff in generated_3dmm:
-            for i in coeff:
-                f.write(str(i)[:7]   + '  '+'\t')
-            f.write('\n')
+    if txt_path is not None:
+        with open(txt_path, 'w') as f:
+            for frame_coeff in generated_3dmm:
+                for i in frame_coeff:
+                    f.write(str(i)[:7]   + '  '+'\t')
+                f.write('\n')
 
-    target_semantics_list = [] 
     frame_num = generated_3dmm.shape[0]
     data['frame_num'] = frame_num
-    for frame_idx in range(frame_num):
-        target_semantics = transform_semantic_target(generated_3dmm, frame_idx, semantic_radius)
-        target_semantics_list.append(target_semantics)
-
-    remainder = frame_num%batch_size
-    if remainder!=0:
-        for _ in range(batch_size-remainder):
-            target_semantics_list.append(target_semantics)
-
-    target_semantics_np = np.array(target_semantics_list)             #frame_num 70 semantic_radius*2+1
-    target_semantics_np = target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
-    data['target_semantics_list'] = torch.FloatTensor(target_semantics_np)
+    data['target_coeff'] = torch.FloatTensor(generated_3dmm)            #frame_num 70
+    data['semantic_radius'] = semantic_radius
+    if build_windows:
+        data['target_semantics_list'] = torch.FloatTensor(build_target_semantics(generated_3dmm, batch_size, semantic_radius))
     data['video_name'] = video_name
     data['audio_path'] = audio_path
     
@@ -90,6 +97,27 @@ def transform_semantic_1(semantic, semantic_radius):
     coeff_3dmm = np.concatenate(semantic_list, 0)
     return coeff_3dmm.transpose(1,0)
 
+def target_window_index(num_frames, semantic_radius, start=0, end=None):
+    """
+    (end-start, 2*semantic_radius+1) index of the frames around each frame, clamped to the clip
+    """
+    end = num_frames if end is None else end
+    index = np.arange(start, end)[:, None] + np.arange(-semantic_radius, semantic_radius+1)[None]
+    return np.clip(index, 0, num_frames-1)
+
+def build_target_semantics(coeff_3dmm, batch_size, semantic_radius):
+    """
+    transform_semantic_target of every frame in one gather, padded with the last window 
+    to a multiple of batch_size: (batch_size, -1, 70, semantic_radius*2+1)
+    """
+    num_frames = coeff_3dmm.shape[0]
+    index = target_window_index(num_frames, semantic_radius)
+    remainder = num_frames%batch_size
+    if remainder!=0:
+        index = np.concatenate([index, np.repeat(index[-1:], batch_size-remainder, axis=0)], 0)
+    target_semantics_np = coeff_3dmm[index].transpose(0, 2, 1)             #frame_num 70 semantic_radius*2+1
+    return target_semantics_np.reshape(batch_size, -1, target_semantics_np.shape[-2], target_semantics_np.shape[-1])
+
 def transform_semantic_target(coeff_3dmm, frame_index, semantic_radius):
     num_frames = coeff_3dmm.shape[0]
     seq = list(range(frame_index- semantic_radius, frame_index + semantic_radius+1))
@@ -1,5 +1,6 @@
 import torch, uuid
-import os, sys, shutil
+import os, sys, shutil, gc
+from collections import OrderedDict
 from src.utils.preprocess import CropAndExtract
 from src.test_audio2coeff import Audio2Coeff  
 from src.facerender.animate import AnimateFromCoeff
@@ -18,7 +19,8 @@ def mp3_to_wav(mp3_filename,wav_filename,frame_rate):
 
 class SadTalker():
 
-    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', lazy_load=False):
+    def __init__(self, checkpoint_path='checkpoints', config_path='src/config', lazy_load=False, max_cached_models=2, preprocess_cache_dir=None,
+                 render_batch_size=0, render_max_wait=0.01):
 
         if torch.cuda.is_available() :
             device = "cuda"
@@ -31,6 +33,48 @@ class SadTalker():
 
         self.checkpoint_path = checkpoint_path
         self.config_path = config_path
+
+        # models stay resident between requests, the least recently used variants are dropped first
+        self.max_cached_models = max_cached_models
+        self.preprocess_cache_dir = preprocess_cache_dir
+        # > 0: the facerenders batch the frames of concurrent renders, up to this many frames per call
+        self.render_batch_size = render_batch_size
+        self.render_max_wait = render_max_wait
+        self.models = OrderedDict()       # size -> (CropAndExtract, Audio2Coeff)
+        self.facerenders = OrderedDict()  # (size, full) -> AnimateFromCoeff, mapping/facerender config differ for `full`
+
+    def _cache_get(self, cache, key, build):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        value = build()
+        cache[key] = value
+        while len(cache) > self.max_cached_models:
+            _, evicted = cache.popitem(last=False)
+            if getattr(evicted, 'scheduler', None) is not None:
+                # the renders holding the scheduler are finished first, see RenderScheduler.hold
+                evicted.scheduler.close()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        return value
+
+    def load_models(self, size=256, preprocess='crop'):
+        """
+        Return (sadtalker_paths, preprocess_model, audio_to_coeff, animate_from_coeff) for this 
+        size/preprocess, building them only the first time they are requested.
+        """
+        sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
+
+        preprocess_model, audio_to_coeff = self._cache_get(self.models, size, 
+                    lambda: (CropAndExtract(sadtalker_paths, self.device, cache_dir=self.preprocess_cache_dir), Audio2Coeff(sadtalker_paths, self.device)))
+        animate_from_coeff = self._cache_get(self.facerenders, (size, 'full' in preprocess), 
+                    lambda: AnimateFromCoeff(sadtalker_paths, self.device))
+        if self.render_batch_size > 0:
+            animate_from_coeff.enable_scheduler(self.render_batch_size, self.render_max_wait)
+
+        return sadtalker_paths, preprocess_model, audio_to_coeff, animate_from_coeff
       
 
     def test(self, source_image, driven_audio, preprocess='crop', 
@@ -43,12 +87,8 @@ class SadTalker():
         length_of_audio = 0, use_blink=True,
         result_dir='./results/'):
 
-        self.sadtalker_paths = init_path(self.checkpoint_path, self.config_path, size, False, preprocess)
+        self.sadtalker_paths, self.preprocess_model, self.audio_to_coeff, self.animate_from_coeff = self.load_models(size, preprocess)
         print(self.sadtalker_paths)
-            
-        self.audio_to_coeff = Audio2Coeff(self.sadtalker_paths, self.device)
-        self.preprocess_model = CropAndExtract(self.sadtalker_paths, self.device)
-        self.animate_from_coeff = AnimateFromCoeff(self.sadtalker_paths, self.device)
 
         time_tag = str(uuid.uuid4())
         save_dir = os.path.join(result_dir, time_tag)
@@ -93,9 +133,9 @@ class SadTalker():
         #crop image and extract 3dmm from image
         first_frame_dir = os.path.join(save_dir, 'first_frame_dir')
         os.makedirs(first_frame_dir, exist_ok=True)
-        first_coeff_path, crop_pic_path, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
+        first_coeff, crop_pic_path, crop_info = self.preprocess_model.generate(pic_path, first_frame_dir, preprocess, True, size)
         
-        if first_coeff_path is None:
+        if first_coeff is None:
             raise AttributeError("No face is detected")
 
         if use_ref_video:
@@ -104,51 +144,45 @@ class SadTalker():
             ref_video_frame_dir = os.path.join(save_dir, ref_video_videoname)
             os.makedirs(ref_video_frame_dir, exist_ok=True)
             print('3DMM Extraction for the reference video providing pose')
-            ref_video_coeff_path, _, _ =  self.preprocess_model.generate(ref_video, ref_video_frame_dir, preprocess, source_image_flag=False)
+            ref_video_coeff, _, _ =  self.preprocess_model.generate(ref_video, ref_video_frame_dir, preprocess, source_image_flag=False)
         else:
-            ref_video_coeff_path = None
+            ref_video_coeff = None
 
         if use_ref_video:
             if ref_info == 'pose':
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = None
+                ref_pose_coeff = ref_video_coeff
+                ref_eyeblink_coeff = None
             elif ref_info == 'blink':
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = ref_video_coeff_path
+                ref_pose_coeff = None
+                ref_eyeblink_coeff = ref_video_coeff
             elif ref_info == 'pose+blink':
-                ref_pose_coeff_path = ref_video_coeff_path
-                ref_eyeblink_coeff_path = ref_video_coeff_path
+                ref_pose_coeff = ref_video_coeff
+                ref_eyeblink_coeff = ref_video_coeff
             elif ref_info == 'all':            
-                ref_pose_coeff_path = None
-                ref_eyeblink_coeff_path = None
+                ref_pose_coeff = None
+                ref_eyeblink_coeff = None
             else:
                 raise('error in refinfo')
         else:
-            ref_pose_coeff_path = None
-            ref_eyeblink_coeff_path = None
+            ref_pose_coeff = None
+            ref_eyeblink_coeff = None
 
         #audio2ceoff
         if use_ref_video and ref_info == 'all':
-            coeff_path = ref_video_coeff_path # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            coeff = ref_video_coeff # self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff)
         else:
-            batch = get_data(first_coeff_path, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff_path, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
-            coeff_path = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff_path)
+            batch = get_data(first_coeff, audio_path, self.device, ref_eyeblink_coeff_path=ref_eyeblink_coeff, still=still_mode, idlemode=use_idle_mode, length_of_audio=length_of_audio, use_blink=use_blink) # longer audio?
+            coeff = self.audio_to_coeff.generate(batch, save_dir, pose_style, ref_pose_coeff)
 
         #coeff2video
-        data = get_facerender_data(coeff_path, crop_pic_path, first_coeff_path, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
+        data = get_facerender_data(coeff, crop_pic_path, first_coeff, audio_path, batch_size, still_mode=still_mode, preprocess=preprocess, size=size, expression_scale = exp_scale)
         return_path = self.animate_from_coeff.generate(data, save_dir,  pic_path, crop_info, enhancer='gfpgan' if use_enhancer else None, preprocess=preprocess, img_size=size)
         video_name = data['video_name']
         print(f'The generated video is named {video_name} in {save_dir}')
 
-        del self.preprocess_model
-        del self.audio_to_coeff
-        del self.animate_from_coeff
-
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.synchronize()
-            
-        import gc; gc.collect()
         
         return return_path
 
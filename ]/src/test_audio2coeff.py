@@ -1,17 +1,17 @@
 import os 
+import hashlib
 import torch
+from collections import OrderedDict
 import numpy as np
 from scipy.io import savemat, loadmat
 from yacs.config import CfgNode as CN
 from scipy.signal import savgol_filter
 
-import safetensors
-import safetensors.torch 
-
 from src.audio2pose_models.audio2pose import Audio2Pose
 from src.audio2exp_models.networks import SimpleWrapperV2 
 from src.audio2exp_models.audio2exp import Audio2Exp
-from src.utils.safetensor_helper import load_x_from_safetensor  
+from src.utils.safetensor_helper import load_safetensor, load_x_from_safetensor  
+from src.utils.coeff import CoeffResult, load_coeff
 
 def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
     checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
@@ -24,7 +24,7 @@ def load_cpk(checkpoint_path, model=None, optimizer=None, device="cpu"):
 
 class Audio2Coeff():
 
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, embedding_cache_size=4):
         #load config
         fcfg_pose = open(sadtalker_path['audio2pose_yaml_path'])
         cfg_pose = CN.load_cfg(fcfg_pose)
@@ -42,7 +42,7 @@ class Audio2Coeff():
         
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
+                checkpoints = load_safetensor(sadtalker_path['checkpoint'])
                 self.audio2pose_model.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2pose'))
             else:
                 load_cpk(sadtalker_path['audio2pose_checkpoint'], model=self.audio2pose_model, device=device)
@@ -57,7 +57,7 @@ class Audio2Coeff():
         netG.eval()
         try:
             if sadtalker_path['use_safetensor']:
-                checkpoints = safetensors.torch.load_file(sadtalker_path['checkpoint'])
+                checkpoints = load_safetensor(sadtalker_path['checkpoint'])
                 netG.load_state_dict(load_x_from_safetensor(checkpoints, 'audio2exp'))
             else:
                 load_cpk(sadtalker_path['audio2exp_checkpoint'], model=netG, device=device)
@@ -71,19 +71,68 @@ class Audio2Coeff():
  
         self.device = device
 
-    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None):
+        # the audio encoders of audio2exp and audio2pose are the same wav2lip stack, 
+        # when the checkpoint holds the same weights the embeddings are computed once
+        exp_encoder = netG.audio_encoder.state_dict()
+        pose_encoder = self.audio2pose_model.audio_encoder.audio_encoder.state_dict()
+        self.shared_audio_encoder = exp_encoder.keys() == pose_encoder.keys() and \
+                                    all(torch.equal(exp_encoder[k], pose_encoder[k]) for k in exp_encoder)
+
+        # audio hash -> (audio2exp embedding, audio2pose embedding), most recent last
+        self.embedding_cache_size = embedding_cache_size
+        self.embedding_cache = OrderedDict()
+
+    def audio_embeddings(self, batch):
+        """
+        Audio embeddings of batch['indiv_mels'] for audio2exp and audio2pose, reused when 
+        the same audio is generated again (e.g. with another pose style).
+        """
+        indiv_mels = batch['indiv_mels']
+        if self.embedding_cache_size > 0:
+            key = hashlib.sha1(indiv_mels.cpu().numpy().tobytes()).hexdigest()
+            if key in self.embedding_cache:
+                self.embedding_cache.move_to_end(key)
+                return self.embedding_cache[key]
+
+        audio_emb_exp = self.audio2exp_model.encode(indiv_mels)
+        if self.shared_audio_encoder:
+            audio_emb_pose = audio_emb_exp
+        else:
+            audio_emb_pose = self.audio2pose_model.encode(indiv_mels)
+
+        if self.embedding_cache_size > 0:
+            self.embedding_cache[key] = (audio_emb_exp, audio_emb_pose)
+            while len(self.embedding_cache) > self.embedding_cache_size:
+                self.embedding_cache.popitem(last=False)
+        return audio_emb_exp, audio_emb_pose
+
+    def generate(self, batch, coeff_save_dir, pose_style, ref_pose_coeff_path=None, verbose=False):
+        return self.generate_styles(batch, coeff_save_dir, [pose_style], ref_pose_coeff_path, verbose)[0]
+
+    def generate_styles(self, batch, coeff_save_dir, pose_styles, ref_pose_coeff_path=None, verbose=False):
+        """
+        Coefficients of the same audio with several pose styles: audio2exp runs once and the 
+        audio2pose decoder runs on all the styles as one batch. Returns one CoeffResult per style, 
+        named pic##audio for a single style and pic##audio##style<n> otherwise, 
+        saved as .mat in coeff_save_dir with verbose.
+        """
 
         with torch.no_grad():
             #test
-            results_dict_exp= self.audio2exp_model.test(batch)
+            audio_emb_exp, audio_emb_pose = self.audio_embeddings(batch)
+            results_dict_exp= self.audio2exp_model.test(batch, audio_emb=audio_emb_exp)
             exp_pred = results_dict_exp['exp_coeff_pred']                         #bs T 64
 
             #for class_id in  range(1):
             #class_id = 0#(i+10)%45
             #class_id = random.randint(0,46)                                   #46 styles can be selected 
-            batch['class'] = torch.LongTensor([pose_style]).to(self.device)
-            results_dict_pose = self.audio2pose_model.test(batch) 
-            pose_pred = results_dict_pose['pose_pred']                        #bs T 6
+            num_styles = len(pose_styles)
+            pose_batch = {'ref': batch['ref'].expand(num_styles, -1, -1),
+                          'indiv_mels': batch['indiv_mels'],
+                          'num_frames': batch['num_frames'],
+                          'class': torch.LongTensor(pose_styles).to(self.device)}
+            results_dict_pose = self.audio2pose_model.test(pose_batch, audio_emb=audio_emb_pose.expand(num_styles, -1, -1)) 
+            pose_pred = results_dict_pose['pose_pred']                        #styles T 6
 
             pose_len = pose_pred.shape[1]
             if pose_len<13: 
@@ -92,22 +141,29 @@ class Audio2Coeff():
             else:
                 pose_pred = torch.Tensor(savgol_filter(np.array(pose_pred.cpu()), 13, 2, axis=1)).to(self.device) 
             
-            coeffs_pred = torch.cat((exp_pred, pose_pred), dim=-1)            #bs T 70
+            coeffs = []
+            for i, pose_style in enumerate(pose_styles):
+                coeffs_pred = torch.cat((exp_pred[0], pose_pred[i]), dim=-1)            #T 70
 
-            coeffs_pred_numpy = coeffs_pred[0].clone().detach().cpu().numpy() 
+                coeffs_pred_numpy = coeffs_pred.clone().detach().cpu().numpy() 
 
-            if ref_pose_coeff_path is not None: 
-                 coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
-        
-            savemat(os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name'])),  
-                    {'coeff_3dmm': coeffs_pred_numpy})
+                if ref_pose_coeff_path is not None: 
+                     coeffs_pred_numpy = self.using_refpose(coeffs_pred_numpy, ref_pose_coeff_path)
+
+                if num_styles == 1:
+                    coeff_name = '%s##%s'%(batch['pic_name'], batch['audio_name'])
+                else:
+                    coeff_name = '%s##%s##style%d'%(batch['pic_name'], batch['audio_name'], pose_style)
+                coeff = CoeffResult(coeff_name, coeffs_pred_numpy)
+                if verbose:
+                    coeff.save(coeff_save_dir)
+                coeffs.append(coeff)
 
-            return os.path.join(coeff_save_dir, '%s##%s.mat'%(batch['pic_name'], batch['audio_name']))
+            return coeffs
     
     def using_refpose(self, coeffs_pred_numpy, ref_pose_coeff_path):
         num_frames = coeffs_pred_numpy.shape[0]
-        refpose_coeff_dict = loadmat(ref_pose_coeff_path)
-        refpose_coeff = refpose_coeff_dict['coeff_3dmm'][:,64:70]
+        refpose_coeff = load_coeff(ref_pose_coeff_path).coeff_3dmm[:,64:70]
         refpose_num_frames = refpose_coeff.shape[0]
         if refpose_num_frames<num_frames:
             div = num_frames//refpose_num_frames
@@ -1,6 +1,8 @@
 import librosa
 import librosa.filters
 import numpy as np
+import torch
+import torch.nn.functional as F
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
@@ -134,3 +136,81 @@ def _denormalize(D):
         return (((D + hp.max_abs_value) * -hp.min_level_db / (2 * hp.max_abs_value)) + hp.min_level_db)
     else:
         return ((D * -hp.min_level_db / hp.max_abs_value) + hp.min_level_db)
+
+
+##########################################################
+# torch version of melspectrogram, for batches of audio on any device.
+# Resampling (load_wav) stays on librosa.
+_mel_basis_torch = {}
+_window_torch = {}
+
+# default pad_mode of librosa.stft in the pinned librosa==0.9.2
+_librosa_pad_mode = 'reflect'
+
+def _get_torch_buffers(device, dtype):
+    key = (str(device), dtype)
+    if key not in _mel_basis_torch:
+        global _mel_basis
+        if _mel_basis is None:
+            _mel_basis = _build_mel_basis()
+        _mel_basis_torch[key] = torch.tensor(_mel_basis, dtype=dtype, device=device)
+        _window_torch[key] = torch.hann_window(hp.win_size or hp.n_fft, periodic=True, dtype=dtype, device=device)
+    return _mel_basis_torch[key], _window_torch[key]
+
+def preemphasis_torch(wav, k, preemphasize=True):
+    """
+    wav: (B, L), same as lfilter([1, -k], [1], wav) along the last axis.
+    """
+    if preemphasize:
+        return torch.cat([wav[:, :1], wav[:, 1:] - k * wav[:, :-1]], dim=1)
+    return wav
+
+def _amp_to_db_torch(x):
+    min_level = np.exp(hp.min_level_db / 20 * np.log(10))
+    return 20 * torch.log10(torch.clamp(x, min=min_level))
+
+def _normalize_torch(S):
+    if hp.allow_clipping_in_normalization:
+        if hp.symmetric_mels:
+            return torch.clamp((2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value,
+                               -hp.max_abs_value, hp.max_abs_value)
+        else:
+            return torch.clamp(hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db)), 0, hp.max_abs_value)
+
+    if hp.symmetric_mels:
+        return (2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value
+    else:
+        return hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db))
+
+def melspectrogram_torch(wav, device='cpu', dtype=torch.float32):
+    """
+    Same as melspectrogram, computed with torch.
+    wav: a 1d array/tensor, returns (num_mels, T) tensor
+         or a list of them (any lengths), returns a list of (num_mels, T_i) tensors computed in one batch
+    """
+    assert not hp.use_lws, 'melspectrogram_torch follows the librosa stft'
+    single = not isinstance(wav, (list, tuple))
+    wavs = [wav] if single else wav
+    wavs = [torch.as_tensor(np.asarray(w) if not torch.is_tensor(w) else w).to(device=device, dtype=dtype) for w in wavs]
+    lengths = [w.shape[0] for w in wavs]
+
+    mel_basis, window = _get_torch_buffers(device, dtype)
+    hop_size = get_hop_size()
+    pad = hp.n_fft // 2
+
+    # the preemphasis is causal, zeros at the end do not change the valid samples
+    y = torch.stack([F.pad(w, (0, max(lengths) - w.shape[0])) for w in wavs])    # B L
+    y = preemphasis_torch(y, hp.preemphasis, hp.preemphasize)
+
+    # center padding of librosa.stft, done per audio so every item pads its own end
+    y = torch.stack([F.pad(F.pad(y[i:i+1, :lengths[i]].unsqueeze(0), (pad, pad), mode=_librosa_pad_mode)[0, 0], 
+                           (0, max(lengths) - lengths[i])) for i in range(len(wavs))])   # B L+2*pad
+
+    D = torch.stft(y, n_fft=hp.n_fft, hop_length=hop_size, win_length=hp.win_size, window=window,
+                   center=False, return_complex=True)   # B n_fft//2+1 T
+    S = _amp_to_db_torch(torch.matmul(mel_basis, D.abs())) - hp.ref_level_db
+    if hp.signal_normalization:
+        S = _normalize_torch(S)
+
+    mels = [S[i, :, :1 + lengths[i] // hop_size] for i in range(len(wavs))]
+    return mels[0] if single else mels
@@ -0,0 +1,38 @@
+import os
+import numpy as np
+from scipy.io import loadmat, savemat
+
+
+class CoeffResult():
+    """
+    3DMM coefficients handed from one stage to the next in memory.
+    name:       file name without extension, e.g. `pic` or `pic##audio`
+    coeff_3dmm: (T, 70|73) numpy array, expression 64 + pose 6 (+ crop 3)
+    full_3dmm:  (1, 257) coefficients of the first frame, only for the preprocessing results
+    path:       the .mat file, if the result has been saved or loaded from disk
+    """
+    def __init__(self, name, coeff_3dmm, full_3dmm=None, path=None):
+        self.name = name
+        self.coeff_3dmm = coeff_3dmm
+        self.full_3dmm = full_3dmm
+        self.path = path
+
+    def save(self, save_dir):
+        path = os.path.join(save_dir, self.name + '.mat')
+        data = {'coeff_3dmm': self.coeff_3dmm}
+        if self.full_3dmm is not None:
+            data['full_3dmm'] = self.full_3dmm
+        savemat(path, data)
+        self.path = path
+        return path
+
+
+def load_coeff(coeff):
+    """
+    coeff: a CoeffResult or the path of a .mat written by one of the stages
+    """
+    if coeff is None or isinstance(coeff, CoeffResult):
+        return coeff
+    data = loadmat(coeff)
+    name = os.path.splitext(os.path.split(coeff)[-1])[0]
+    return CoeffResult(name, data['coeff_3dmm'], data.get('full_3dmm'), path=coeff)
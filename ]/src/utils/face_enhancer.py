@@ -5,7 +5,7 @@ from gfpgan import GFPGANer
 
 from tqdm import tqdm
 
-from src.utils.videoio import load_video_to_cv2
+from src.utils.videoio import VideoReader
 
 import cv2
 
@@ -32,8 +32,7 @@ def enhancer_generator_with_len(images, method='gfpgan', bg_upsampler='realesrga
     call len()"""
 
     if os.path.isfile(images): # handle video to images
-        # TODO: Create a generator version of load_video_to_cv2
-        images = load_video_to_cv2(images)
+        images = VideoReader(images, prefetch=8)
 
     gen = enhancer_generator_no_len(images, method=method, bg_upsampler=bg_upsampler)
     gen_with_len = GeneratorWithLen(gen, len(images))
@@ -45,8 +44,8 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
     the enhancer function. """
 
     print('face enhancer....')
-    if not isinstance(images, list) and os.path.isfile(images): # handle video to images
-        images = load_video_to_cv2(images)
+    if isinstance(images, str) and os.path.isfile(images): # handle video to images
+        images = VideoReader(images, prefetch=8)
 
     # ------------------------ set up GFPGAN restorer ------------------------
     if  method == 'gfpgan':
@@ -108,9 +107,10 @@ def enhancer_generator_no_len(images, method='gfpgan', bg_upsampler='realesrgan'
         bg_upsampler=bg_upsampler)
 
     # ------------------------ restore ------------------------
-    for idx in tqdm(range(len(images)), 'Face Enhancer:'):
+    # images can be a list or any iterable of frames, e.g. the frames streamed from the face renderer
+    for image in tqdm(images, 'Face Enhancer:'):
         
-        img = cv2.cvtColor(images[idx], cv2.COLOR_RGB2BGR)
+        img = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
         
         # restore faces and background if necessary
         cropped_faces, restored_faces, r_img = restorer.enhance(
@@ -1,24 +1,30 @@
 import numpy as np
 import cv2, os, sys, torch
+import json, shutil, hashlib, tempfile
 from tqdm import tqdm
+from itertools import islice, chain, tee
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image 
 
 # 3dmm extraction
-import safetensors
-import safetensors.torch 
 from src.face3d.util.preprocess import align_img
 from src.face3d.util.load_mats import load_lm3d
 from src.face3d.models import networks
 
 from scipy.io import loadmat, savemat
 from src.utils.croper import Preprocesser
+from src.utils.videoio import VideoReader
+from src.utils.coeff import CoeffResult, load_coeff
 
 
 import warnings
 
-from src.utils.safetensor_helper import load_x_from_safetensor 
+from src.utils.safetensor_helper import load_safetensor, load_x_from_safetensor 
 warnings.filterwarnings("ignore")
 
+# bump when the stored preprocessing results change
+CACHE_VERSION = 'v1'
+
 def split_coeff(coeffs):
         """
         Return:
@@ -44,13 +50,13 @@ def split_coeff(coeffs):
 
 
 class CropAndExtract():
-    def __init__(self, sadtalker_path, device):
+    def __init__(self, sadtalker_path, device, recon_batch_size=16, num_workers=4, prefetch=16, cache_dir=None):
 
         self.propress = Preprocesser(device)
         self.net_recon = networks.define_net_recon(net_recon='resnet50', use_last_fc=False, init_path='').to(device)
         
         if sadtalker_path['use_safetensor']:
-            checkpoint = safetensors.torch.load_file(sadtalker_path['checkpoint'])    
+            checkpoint = load_safetensor(sadtalker_path['checkpoint'])    
             self.net_recon.load_state_dict(load_x_from_safetensor(checkpoint, 'face_3drecon'))
         else:
             checkpoint = torch.load(sadtalker_path['path_of_net_recon_model'], map_location=torch.device(device))    
@@ -59,8 +65,71 @@ class CropAndExtract():
         self.net_recon.eval()
         self.lm3d_std = load_lm3d(sadtalker_path['dir_of_BFM_fitting'])
         self.device = device
+        self.recon_batch_size = recon_batch_size
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+
+        # persistent preprocessing results, keyed by the content of the input file
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def align_frame(self, frame, lm1):
+        W,H = frame.size
+        lm1 = lm1.reshape([-1, 2]).copy()
     
-    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256):
+        if np.mean(lm1) == -1:
+            lm1 = (self.lm3d_std[:, :2]+1)/2.
+            lm1 = np.concatenate(
+                [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
+            )
+        else:
+            lm1[:, -1] = H - 1 - lm1[:, -1]
+
+        trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
+
+        trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+        return trans_params, np.array(im1)
+    
+    def cache_key(self, input_path, crop_or_resize, source_image_flag, pic_size):
+        h = hashlib.sha1()
+        with open(input_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(('%s_%s_%d_%d' % (CACHE_VERSION, crop_or_resize.lower(), int(source_image_flag), pic_size)).encode('utf-8'))
+        return h.hexdigest()
+
+    def load_cache(self, cache_path, pic_name, png_path):
+        shutil.copyfile(os.path.join(cache_path, 'frame.png'), png_path)
+        coeff = load_coeff(os.path.join(cache_path, 'coeff.mat'))
+        coeff.name = pic_name
+        lm = np.loadtxt(os.path.join(cache_path, 'landmarks.txt')).astype(np.float32).reshape([-1, 68, 2])
+        with open(os.path.join(cache_path, 'crop_info.json')) as f:
+            size, crop, quad = json.load(f)
+        crop_info = (tuple(size), None if crop is None else tuple(crop), quad)
+        return coeff, lm, crop_info
+
+    def save_cache(self, cache_path, coeff, png_path, lm, crop_info):
+        # write in a temporary folder and rename, concurrent jobs never see a partial entry
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir)
+        savemat(os.path.join(tmp_path, 'coeff.mat'), {'coeff_3dmm': coeff.coeff_3dmm, 'full_3dmm': coeff.full_3dmm})
+        shutil.copyfile(png_path, os.path.join(tmp_path, 'frame.png'))
+        np.savetxt(os.path.join(tmp_path, 'landmarks.txt'), lm.reshape(-1))
+        size, crop, quad = crop_info
+        with open(os.path.join(tmp_path, 'crop_info.json'), 'w') as f:
+            json.dump([[int(v) for v in size], 
+                       None if crop is None else [int(v) for v in crop], 
+                       None if quad is None else [float(v) for v in quad]], f)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError: # already stored by another job
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def generate(self, input_path, save_dir, crop_or_resize='crop', source_image_flag=False, pic_size=256, verbose=False):
+        """
+        Returns (CoeffResult, path of the cropped png, crop_info). The .mat and the landmarks 
+        are written in save_dir only with verbose, and reused when they are already there.
+        """
 
         pic_name = os.path.splitext(os.path.split(input_path)[-1])[0]  
 
@@ -71,100 +140,112 @@ class CropAndExtract():
         #load input
         if not os.path.isfile(input_path):
             raise ValueError('input_path must be a valid path to video/image file')
-        elif input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
+
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, self.cache_key(input_path, crop_or_resize, source_image_flag, pic_size))
+            if os.path.isdir(cache_path):
+                print(' Using cached preprocessing results.')
+                coeff, lm, crop_info = self.load_cache(cache_path, pic_name, png_path)
+                if verbose:
+                    coeff.save(save_dir)
+                    np.savetxt(landmarks_path, lm.reshape(-1))
+                return coeff, png_path, crop_info
+
+        if input_path.split('.')[-1] in ['jpg', 'png', 'jpeg']:
             # loader for first frame
-            full_frames = [cv2.imread(input_path)]
-            fps = 25
+            full_frames = iter([cv2.cvtColor(cv2.imread(input_path), cv2.COLOR_BGR2RGB)])
         else:
-            # loader for videos
-            video_stream = cv2.VideoCapture(input_path)
-            fps = video_stream.get(cv2.CAP_PROP_FPS)
-            full_frames = [] 
-            while 1:
-                still_reading, frame = video_stream.read()
-                if not still_reading:
-                    video_stream.release()
-                    break 
-                full_frames.append(frame) 
-                if source_image_flag:
-                    break
+            # loader for videos, the frames are decoded lazily instead of being held in memory
+            full_frames = iter(VideoReader(input_path, max_frames=1 if source_image_flag else None, prefetch=self.prefetch))
 
-        x_full_frames= [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  for frame in full_frames] 
+        first_frame = next(full_frames, None)
+        if first_frame is None:
+            print('No face is detected in the input file')
+            return None, None, None
+        x_full_frames = chain([first_frame], full_frames)
 
         #### crop images as the 
-        if 'crop' in crop_or_resize.lower(): # default crop
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
-            clx, cly, crx, cry = crop
-            lx, ly, rx, ry = quad
-            lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-            oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
-            crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
-        elif 'full' in crop_or_resize.lower():
-            x_full_frames, crop, quad = self.propress.crop(x_full_frames, still=True if 'ext' in crop_or_resize.lower() else False, xsize=512)
+        if 'crop' in crop_or_resize.lower() or 'full' in crop_or_resize.lower(): # default crop
+            # the crop is computed on the first frame and applied to every frame
+            still = True if 'ext' in crop_or_resize.lower() else False
+            rsize, crop, quad = self.propress.get_crop(first_frame, xsize=512)
+            x_full_frames = (self.propress.apply_crop(frame, rsize, crop, quad, still=still) for frame in x_full_frames)
             clx, cly, crx, cry = crop
             lx, ly, rx, ry = quad
             lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
             oy1, oy2, ox1, ox2 = cly+ly, cly+ry, clx+lx, clx+rx
             crop_info = ((ox2 - ox1, oy2 - oy1), crop, quad)
         else: # resize mode
-            oy1, oy2, ox1, ox2 = 0, x_full_frames[0].shape[0], 0, x_full_frames[0].shape[1] 
+            oy1, oy2, ox1, ox2 = 0, first_frame.shape[0], 0, first_frame.shape[1] 
             crop_info = ((ox2 - ox1, oy2 - oy1), None, None)
 
-        frames_pil = [Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames]
-        if len(frames_pil) == 0:
-            print('No face is detected in the input file')
-            return None, None
-
-        # save crop info
-        for frame in frames_pil:
-            cv2.imwrite(png_path, cv2.cvtColor(np.array(frame), cv2.COLOR_RGB2BGR))
+        frames_pil = (Image.fromarray(cv2.resize(frame,(pic_size, pic_size))) for frame in x_full_frames)
 
         # 2. get the landmark according to the detected face. 
         if not os.path.isfile(landmarks_path): 
-            lm = self.propress.predictor.extract_keypoint(frames_pil, landmarks_path)
+            saved_lm = None
+            frames_pil, frames_kp = tee(frames_pil)
+            frames_lm = zip(frames_pil, self.propress.predictor.iter_keypoints(frames_kp))
         else:
             print(' Using saved landmarks.')
-            lm = np.loadtxt(landmarks_path).astype(np.float32)
-            lm = lm.reshape([len(x_full_frames), -1, 2])
-
-        if not os.path.isfile(coeff_path):
-            # load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
-            video_coeffs, full_coeffs = [],  []
-            for idx in tqdm(range(len(frames_pil)), desc='3DMM Extraction In Video:'):
-                frame = frames_pil[idx]
-                W,H = frame.size
-                lm1 = lm[idx].reshape([-1, 2])
-            
-                if np.mean(lm1) == -1:
-                    lm1 = (self.lm3d_std[:, :2]+1)/2.
-                    lm1 = np.concatenate(
-                        [lm1[:, :1]*W, lm1[:, 1:2]*H], 1
-                    )
-                else:
-                    lm1[:, -1] = H - 1 - lm1[:, -1]
-
-                trans_params, im1, lm1, _ = align_img(frame, lm1, self.lm3d_std)
- 
-                trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-                im_t = torch.tensor(np.array(im1)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
-                
-                with torch.no_grad():
-                    full_coeff = self.net_recon(im_t)
-                    coeffs = split_coeff(full_coeff)
-
-                pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
+            saved_lm = np.loadtxt(landmarks_path).astype(np.float32)
+            saved_lm = saved_lm.reshape([-1, 68, 2])
+            frames_lm = zip(frames_pil, saved_lm)
+
+        # 3. load 3dmm paramter generator from Deep3DFaceRecon_pytorch 
+        # the frames go through landmark detection, alignment (in a thread pool) and reconstruction
+        # in mini-batches as they are decoded
+        need_coeff = not os.path.isfile(coeff_path)
+        lm_list, video_coeffs, full_coeffs = [], [], []
+        pbar = tqdm(desc='3DMM Extraction In Video:')
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            while True:
+                batch = list(islice(frames_lm, self.recon_batch_size))
+                if len(batch) == 0:
+                    break
+                last_frame = batch[-1][0]
+                lm_list.append(np.stack([item[1] for item in batch]))
+
+                if need_coeff:
+                    aligned = list(pool.map(self.align_frame, [item[0] for item in batch], [item[1] for item in batch]))
+                    trans_params = np.stack([item[0] for item in aligned])
+                    im_t = torch.tensor(np.stack([item[1] for item in aligned])/255., dtype=torch.float32).permute(0, 3, 1, 2).to(self.device)
+
+                    with torch.no_grad():
+                        full_coeff = self.net_recon(im_t)
+                        coeffs = split_coeff(full_coeff)
+
+                    pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
  
-                pred_coeff = np.concatenate([
-                    pred_coeff['exp'], 
-                    pred_coeff['angle'],
-                    pred_coeff['trans'],
-                    trans_params[2:][None],
-                    ], 1)
-                video_coeffs.append(pred_coeff)
-                full_coeffs.append(full_coeff.cpu().numpy())
+                    pred_coeff = np.concatenate([
+                        pred_coeff['exp'], 
+                        pred_coeff['angle'],
+                        pred_coeff['trans'],
+                        trans_params[:, 2:],
+                        ], 1)
+                    video_coeffs.append(pred_coeff)
+                    full_coeffs.append(full_coeff.cpu().numpy())
+                pbar.update(len(batch))
+        pbar.close()
+
+        # save crop info
+        cv2.imwrite(png_path, cv2.cvtColor(np.array(last_frame), cv2.COLOR_RGB2BGR))
 
-            semantic_npy = np.array(video_coeffs)[:,0] 
+        lm = np.concatenate(lm_list, 0)
+        if saved_lm is None and verbose:
+            np.savetxt(landmarks_path, lm.reshape(-1))
+
+        if need_coeff:
+            semantic_npy = np.concatenate(video_coeffs, 0)
+            full_3dmm = np.concatenate(full_coeffs, 0)[:1]
+
+            coeff = CoeffResult(pic_name, semantic_npy, full_3dmm)
+            if verbose:
+                coeff.save(save_dir)
+        else:
+            coeff = load_coeff(coeff_path)
 
-            savemat(coeff_path, {'coeff_3dmm': semantic_npy, 'full_3dmm': np.array(full_coeffs)[0]})
+        if self.cache_dir is not None:
+            self.save_cache(cache_path, coeff, png_path, lm, crop_info)
 
-        return coeff_path, png_path, crop_info
+        return coeff, png_path, crop_info
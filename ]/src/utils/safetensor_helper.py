@@ -1,8 +1,42 @@
+import os
+from safetensors import safe_open
 
 
+_checkpoints = {}
+
+class SafetensorCheckpoint(object):
+    """
+    Memory-mapped .safetensors file, a tensor is only read when it is requested.
+    """
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.handle = safe_open(checkpoint_path, framework='pt', device='cpu')
+
+    def keys(self):
+        return self.handle.keys()
+
+    def __getitem__(self, key):
+        return self.handle.get_tensor(key)
+
+    def items(self):
+        for k in self.keys():
+            yield k, self[k]
+
+
+def load_safetensor(checkpoint_path):
+    """
+    Open the checkpoint once per process, all the sub-models slice their weights from it.
+    """
+    checkpoint_path = os.path.abspath(checkpoint_path)
+    if checkpoint_path not in _checkpoints:
+        _checkpoints[checkpoint_path] = SafetensorCheckpoint(checkpoint_path)
+    return _checkpoints[checkpoint_path]
+
 def load_x_from_safetensor(checkpoint, key):
+    # only the tensors of this prefix are read from the file
     x_generator = {}
-    for k,v in checkpoint.items():
+    for k in checkpoint.keys():
         if key in k:
-            x_generator[k.replace(key+'.', '')] = v
-    return x_generator
\ No newline at end of file
+            x_generator[k.replace(key+'.', '')] = checkpoint[k]
+    return x_generator
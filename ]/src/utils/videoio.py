@@ -1,21 +1,99 @@
 import shutil
 import uuid
+import queue
+import threading
+import subprocess
 
 import os
 
 import cv2
+import numpy as np
 
-def load_video_to_cv2(input_path):
-    video_stream = cv2.VideoCapture(input_path)
-    fps = video_stream.get(cv2.CAP_PROP_FPS)
-    full_frames = [] 
-    while 1:
-        still_reading, frame = video_stream.read()
-        if not still_reading:
+_END = object()
+
+class VideoReader(object):
+    """
+    Decode a video frame by frame instead of loading all the frames in memory.
+    With prefetch > 0, up to `prefetch` frames are decoded ahead in a background thread.
+    """
+
+    def __init__(self, input_path, rgb=True, max_frames=None, prefetch=0):
+        self.input_path = input_path
+        self.rgb = rgb
+        self.max_frames = max_frames
+        self.prefetch = prefetch
+
+        video_stream = cv2.VideoCapture(input_path)
+        self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+        self.num_frames = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        video_stream.release()
+
+    def __len__(self):
+        # from the container header, it can be approximate for some formats
+        if self.max_frames is not None:
+            return min(self.num_frames, self.max_frames)
+        return self.num_frames
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return self._prefetch()
+        return self._read()
+
+    def _read(self):
+        video_stream = cv2.VideoCapture(self.input_path)
+        count = 0
+        try:
+            while self.max_frames is None or count < self.max_frames:
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                if self.rgb:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                count += 1
+                yield frame
+        finally:
             video_stream.release()
-            break 
-        full_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-    return full_frames
+
+    def _prefetch(self):
+        frames = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # give up when the consumer is gone
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for frame in self._read():
+                    if not put(frame):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(_END)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = frames.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+def load_video_to_cv2(input_path):
+    return list(VideoReader(input_path))
 
 def save_video_with_watermark(video, audio, save_path, watermark=False):
     temp_file = str(uuid.uuid4())+'.mp4'
@@ -38,4 +116,91 @@ def save_video_with_watermark(video, audio, save_path, watermark=False):
 
         cmd = r'ffmpeg -y -hide_banner -loglevel error -i "%s" -i "%s" -filter_complex "[1]scale=100:-1[wm];[0][wm]overlay=(main_w-overlay_w)-10:10" "%s"' % (temp_file, watarmark_path, save_path)
         os.system(cmd)
-        os.remove(temp_file)
\ No newline at end of file
+        os.remove(temp_file)
+
+class FFmpegVideoWriter(object):
+    """
+    Encode RGB uint8 frames piped into ffmpeg and mux the audio in the same pass,
+    so the final video is produced by a single encode without temporary files.
+    """
+
+    def __init__(self, save_path, fps=25, audio_path=None):
+        self.save_path = save_path
+        self.fps = fps
+        self.audio_path = audio_path
+        self.proc = None
+
+    def _open(self, frame_w, frame_h):
+        cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+               '-f', 'rawvideo', '-vcodec', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', '%dx%d' % (frame_w, frame_h), '-r', str(self.fps), '-i', '-']
+        if self.audio_path is not None:
+            cmd += ['-i', self.audio_path]
+        # yuv420p needs even sizes, the resized crops can be odd
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p']
+        if self.audio_path is not None:
+            cmd += ['-acodec', 'aac']
+        cmd += [self.save_path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if self.proc is None:
+            self._open(frame.shape[1], frame.shape[0])
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited, report its status rather than the pipe
+            ret = self.proc.wait()
+            self.proc = None
+            raise RuntimeError('ffmpeg exited with code %d while writing %s' % (ret, self.save_path)) from None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        ret = self.proc.wait()
+        self.proc = None
+        if ret != 0:
+            raise RuntimeError('ffmpeg exited with code %d while writing %s' % (ret, self.save_path))
+
+    def abort(self):
+        """stop ffmpeg and remove the partial video, a truncated file would look like a finished one"""
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        if os.path.exists(self.save_path):
+            os.remove(self.save_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def concat_videos(video_paths, save_path, audio_path=None):
+    """
+    Join videos encoded with the same settings without re-encoding them (concat demuxer),
+    and mux the audio in the same pass.
+    """
+    list_path = os.path.splitext(save_path)[0] + '_concat.txt'
+    with open(list_path, 'w') as f:
+        for path in video_paths:
+            f.write("file '%s'\n" % os.path.abspath(path).replace("'", "'\\''"))
+
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+    if audio_path is not None:
+        cmd += ['-i', audio_path, '-map', '0:v', '-map', '1:a', '-acodec', 'aac']
+    cmd += ['-vcodec', 'copy', save_path]
+    ret = subprocess.call(cmd)
+    os.remove(list_path)
+    if ret != 0:
+        raise RuntimeError('ffmpeg failed to write %s' % save_path)
+    return save_path